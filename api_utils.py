@@ -1,4 +1,5 @@
 import json
+import time
 import pandas as pd
 import urllib3
 import requests
@@ -102,14 +103,16 @@ def frame_to_row(df):
 
     return lst
 
-def get_players_on_court_at_start_of_period_df(game_id):
+def get_players_on_court_at_start_of_period_df(game_id, frame=None):
     '''
     :param game_id: game id to get data
+    :param frame: optional play by play data frame of the game, downloaded if not given
     :return: returns starting players on court in every period
     '''
     # Extract data for given game id
-    frame = extract_data(get_pbp_url(game_id))
-    print(frame)
+    if frame is None:
+        frame = extract_data(get_pbp_url(game_id))
+        print(frame)
     # Filter out as to only include substitutions
     substitutionsOnly = frame[frame["EVENTMSGTYPE"] == 8][['PERIOD', 'EVENTNUM', 'PLAYER1_ID', 'PLAYER2_ID']]
     substitutionsOnly.columns = ['PERIOD', 'EVENTNUM', 'OUT', 'IN']
@@ -188,4 +191,36 @@ def make_players_on_court_csv(id):
     :return: saves a csv to computer of dataframe of starting players at every period of given game
     '''
     players_on_court = get_players_on_court_at_start_of_period_df(id)
-    players_on_court.to_csv('data/{}_players_at_period.csv'.format(id), index=False)
\ No newline at end of file
+    players_on_court.to_csv('data/{}_players_at_period.csv'.format(id), index=False)
+
+def poll_pbp_events(game_id, interval=5, idle_polls=60):
+    '''
+    :param game_id: game id of a live game
+    :param interval: seconds between polls of the play by play endpoint
+    :param idle_polls: stop after this many polls without new events once the 4th quarter or an overtime has ended
+    :return: generator of new play by play rows as dictionaries, in event order
+    A failed poll (HTTP error, bad JSON or an unexpected payload) is retried at the next interval instead of ending
+    the generator, and counts as a poll without new events
+    '''
+    last_event = -1
+    idle = 0
+    period_over = False
+    while True:
+        try:
+            frame = extract_data(get_pbp_url(game_id))
+            new_events = frame[frame['EVENTNUM'] > last_event].sort_values('EVENTNUM')
+        except (requests.RequestException, ValueError, KeyError, IndexError):
+            new_events = []
+        if len(new_events) > 0:
+            idle = 0
+            last_event = new_events['EVENTNUM'].max()
+            last = new_events.iloc[-1]
+            period_over = last['EVENTMSGTYPE'] == 13 and last['PERIOD'] >= 4
+            for row in new_events.to_dict('records'):
+                yield row
+        else:
+            idle += 1
+            # No overtime started after the end of the 4th (or of an overtime) so the game is over
+            if period_over and idle >= idle_polls:
+                return
+        time.sleep(interval)
@@ -0,0 +1,374 @@
+# Import os for relative pathing to data
+import os
+from multiprocessing import Pool
+import numpy as np
+from scipy import linalg, sparse
+from rapm import possession_player_indices, sparse_design_matrix, lambda_to_alpha, alpha_to_lambda, rapm_frame, \
+    lambdas_rapm, four_factors, four_factor_counts, possession_exposure, exposure_table, replacement_column_map, \
+    replacement_pooling_matrix, expand_coefficients
+
+# Out of core RAPM.
+# Every parsed game is saved as a shard: a folder of small numpy files holding the registry column ids of the ten
+# players on the floor, the possession weights and the target columns. Shards are memory mapped when read and the fit
+# streams through them keeping only the weighted Gram matrix X'WX and a few other sums in memory, so memory use depends
+# on the number of players in the registry and not on how many seasons of possessions we fit.
+# X'WX is kept sparse while it is being summed (only players who shared the floor have a non zero entry), so worker
+# processes and cross validation folds stay small. It is only made dense for the solve, one matrix at a time.
+shard_dir = os.path.join(os.path.dirname(__file__), 'data', 'shards')
+
+
+def write_game_shard(possessions, game_id, registry, columns=('points',), directory=shard_dir):
+    '''
+    :param possessions: parsed possessions data frame for one game
+    :param game_id: game id, used as the shard name
+    :param registry: player registry
+    :param columns: target columns to save
+    :param directory: folder the shards live in
+    :return: path of the written shard
+    '''
+    path = os.path.join(directory, str(game_id))
+    os.makedirs(path, exist_ok=True)
+    offense, defense = possession_player_indices(possessions, registry)
+    np.save(os.path.join(path, 'players.npy'), np.concatenate([offense, defense], axis=1).astype(np.int32))
+    np.save(os.path.join(path, 'weights.npy'), possession_weights(possessions))
+    for column in columns:
+        np.save(os.path.join(path, '{}.npy'.format(column)), possessions[column].values.astype(np.float64))
+    return path
+
+
+def possession_weights(possessions):
+    '''
+    :param possessions: parsed possessions data frame
+    :return: possession weight of every row. Our own parser emits one row per possession, Ryan's possession files
+    carry a possessions column
+    '''
+    if 'possessions' in possessions.columns:
+        return possessions['possessions'].values.astype(np.float64)
+    return np.ones(len(possessions))
+
+
+def possession_shard(possessions, target):
+    '''
+    :param possessions: parsed possessions data frame
+    :param target: target column, or one of the rapm.four_factors names
+    :return: the weights and target columns laid out like a loaded shard, so shard_target works on parsed possessions
+    '''
+    shard = {'weights': possession_weights(possessions)}
+    for column in shard_columns(target):
+        shard[column] = possessions[column].values.astype(np.float64)
+    return shard
+
+
+def list_shards(directory=shard_dir):
+    '''
+    :param directory: folder the shards live in
+    :return: sorted list of shard paths
+    '''
+    if not os.path.exists(directory):
+        return []
+    return [os.path.join(directory, d) for d in sorted(os.listdir(directory))
+            if os.path.exists(os.path.join(directory, d, 'players.npy'))]
+
+
+def load_shard(path, columns):
+    '''
+    :param path: shard path
+    :param columns: target columns to load
+    :return: dictionary of memory mapped arrays: players, weights and one entry per target column
+    '''
+    shard = {
+        'players': np.load(os.path.join(path, 'players.npy'), mmap_mode='r'),
+        'weights': np.load(os.path.join(path, 'weights.npy'), mmap_mode='r')
+    }
+    for column in columns:
+        shard[column] = np.load(os.path.join(path, '{}.npy'.format(column)), mmap_mode='r')
+    return shard
+
+
+def new_gram_stats(n_columns):
+    '''
+    :param n_columns: number of columns in the design matrix
+    :return: empty sufficient statistics for a weighted ridge fit with an intercept, plus the possessions played in
+    every column (see accumulate_exposure)
+    '''
+    return {
+        'xtx': sparse.csr_matrix((n_columns, n_columns)),
+        'xtwy': np.zeros(n_columns),
+        'xtw': np.zeros(n_columns),
+        'exposure': np.zeros(n_columns),
+        'w': 0.0,
+        'wy': 0.0,
+        'wyy': 0.0,
+        'n': 0
+    }
+
+
+def add_gram_stats(stats, other):
+    '''
+    :param stats: sufficient statistics, updated in place
+    :param other: sufficient statistics to add in
+    :return: stats
+    '''
+    for k in stats:
+        stats[k] = stats[k] + other[k]
+    return stats
+
+
+def subtract_gram_stats(stats, other):
+    '''
+    :param stats: sufficient statistics
+    :param other: sufficient statistics to take out
+    :return: new sufficient statistics, stats minus other
+    '''
+    return {k: stats[k] - other[k] for k in stats}
+
+
+def resize_gram_stats(stats, old_players, new_players):
+    '''
+    :param stats: sufficient statistics over 2 * old_players columns
+    :param old_players: registry size the statistics were built for
+    :param new_players: registry size to resize to. When shrinking, the players cut off must not be in the statistics
+    :return: new sufficient statistics over 2 * new_players columns. The offensive and defensive blocks are moved
+    so the defensive columns stay offset by the registry size
+    '''
+    keep = min(old_players, new_players)
+    old_columns = np.concatenate([np.arange(keep), np.arange(keep) + old_players])
+    new_columns = np.concatenate([np.arange(keep), np.arange(keep) + new_players])
+    # New column of every old column, -1 for the players cut off
+    column_map = np.full(old_players * 2, -1)
+    column_map[old_columns] = new_columns
+    xtx = stats['xtx'].tocoo()
+    rows = column_map[xtx.row]
+    cols = column_map[xtx.col]
+    kept = (rows >= 0) & (cols >= 0)
+    resized = new_gram_stats(new_players * 2)
+    resized['xtx'] = sparse.csr_matrix((xtx.data[kept], (rows[kept], cols[kept])),
+                                       shape=(new_players * 2, new_players * 2))
+    resized['xtwy'][new_columns] = stats['xtwy'][old_columns]
+    resized['xtw'][new_columns] = stats['xtw'][old_columns]
+    resized['exposure'][new_columns] = stats['exposure'][old_columns]
+    for k in ['w', 'wy', 'wyy', 'n']:
+        resized[k] = stats[k]
+    return resized
+
+
+def accumulate_matrix(stats, x, y, w):
+    '''
+    :param stats: sufficient statistics, updated in place
+    :param x: sparse design matrix
+    :param y: target vector
+    :param w: possession weights
+    :return: stats
+    '''
+    xw = x.T.multiply(w).tocsr()
+    stats['xtx'] = stats['xtx'] + (xw @ x).tocsr()
+    stats['xtwy'] += xw @ y
+    stats['xtw'] += np.asarray(xw.sum(axis=1)).ravel()
+    stats['w'] += w.sum()
+    stats['wy'] += (w * y).sum()
+    stats['wyy'] += (w * y * y).sum()
+    stats['n'] += len(y)
+    return stats
+
+
+def accumulate_exposure(stats, x, possessions):
+    '''
+    :param stats: sufficient statistics, updated in place
+    :param x: sparse design matrix of every possession, including the rows the target is not fit on
+    :param possessions: possession weights, not the target's weights (FGA, rebound chances, ...)
+    :return: stats
+    The exposure is what the replacement level threshold and exposure weighting use, so it is counted in possessions
+    whatever the target is
+    '''
+    stats['exposure'] += possession_exposure(x, possessions)
+    return stats
+
+
+def reduce_gram_stats(stats, pool):
+    '''
+    :param stats: sufficient statistics over the registry's columns
+    :param pool: pooling matrix from rapm.replacement_pooling_matrix
+    :return: the sufficient statistics of the reduced matrix X @ pool
+    '''
+    pool_t = pool.T.tocsr()
+    reduced = dict(stats)
+    reduced['xtx'] = (pool_t @ stats['xtx'] @ pool).tocsr()
+    reduced['xtwy'] = pool_t @ stats['xtwy']
+    reduced['xtw'] = pool_t @ stats['xtw']
+    reduced['exposure'] = pool_t @ stats['exposure']
+    return reduced
+
+
+def shard_columns(target):
+    '''
+    :param target: target column, or one of the rapm.four_factors names
+    :return: the shard columns the target is computed from
+    '''
+    if target in four_factors:
+        numerator, denominator = four_factors[target]
+        return list(numerator) + ([denominator] if denominator != 'possessions' else [])
+    return [target]
+
+
+def shard_target(shard, target, per_possession):
+    '''
+    :param shard: loaded shard
+    :param target: target column, or one of the rapm.four_factors names
+    :param per_possession: if True the target is turned into a per 100 possession value like adjust_to_per_poss.
+    Four factors are always a rate per 100 of their denominator, weighted by the denominator
+    :return: target vector, weights and a mask of the rows that are actual possessions
+    '''
+    if target in four_factors:
+        counts, w = four_factor_counts(dict(shard, possessions=shard['weights']), target)
+        w = np.asarray(w)
+        keep = w > 0
+        return np.where(keep, 100 * np.asarray(counts) / np.where(keep, w, 1), 0), w, keep
+
+    w = np.asarray(shard['weights'])
+    y = np.asarray(shard[target])
+    keep = w > 0
+    if per_possession:
+        y = np.where(keep, 100 * y / np.where(keep, w, 1), 0)
+    return y, w, keep
+
+
+def accumulate_shards(args):
+    '''
+    :param args: tuple of (shard paths, fold of each shard, number of folds, registry size, target, per_possession)
+    :return: list of sufficient statistics, one per fold
+    Takes a single tuple so it can be mapped over a process pool
+    '''
+    paths, shard_folds, folds, n_players, target, per_possession = args
+    stats = [new_gram_stats(n_players * 2) for _ in range(folds)]
+    for path, fold in zip(paths, shard_folds):
+        shard = load_shard(path, shard_columns(target))
+        y, w, keep = shard_target(shard, target, per_possession)
+        players = np.asarray(shard['players'])
+        x = sparse_design_matrix(players[:, 0:5], players[:, 5:10], n_players)
+        accumulate_matrix(stats[fold], x[keep], y[keep], w[keep])
+        accumulate_exposure(stats[fold], x, shard['weights'])
+    return stats
+
+
+def accumulate_shard_folds(paths, n_players, target, per_possession=True, folds=5, processes=1):
+    '''
+    :param paths: shard paths
+    :param n_players: registry size
+    :param target: target column
+    :param per_possession: if True the target is fit per 100 possessions
+    :param folds: number of cross validation folds, games are assigned to folds round robin
+    :param processes: number of worker processes. Each one sums a slice of the shards and the partial sums are merged
+    :return: list of sufficient statistics, one per fold
+    '''
+    shard_folds = [i % folds for i in range(len(paths))]
+    processes = max(1, min(processes, len(paths)))
+    jobs = [(paths[i::processes], shard_folds[i::processes], folds, n_players, target, per_possession)
+            for i in range(processes)]
+    if processes == 1:
+        partials = [accumulate_shards(jobs[0])]
+    else:
+        with Pool(processes) as pool:
+            partials = pool.map(accumulate_shards, jobs)
+
+    stats = partials[0]
+    for partial in partials[1:]:
+        for fold in range(folds):
+            add_gram_stats(stats[fold], partial[fold])
+    return stats
+
+
+def solve_gram_ridge(stats, alpha):
+    '''
+    :param stats: sufficient statistics
+    :param alpha: ridge penalty
+    :return: coefficients and intercept of the weighted ridge regression, the same model RidgeCV fits with
+    fit_intercept=True and sample weights
+    '''
+    # Center X and y on their weighted means so the intercept is not penalized
+    x_mean = stats['xtw'] / stats['w']
+    y_mean = stats['wy'] / stats['w']
+    # The only dense copy of X'WX, made here for the solve
+    a = stats['xtx'].toarray() - np.outer(stats['xtw'], x_mean)
+    a[np.diag_indices_from(a)] += alpha
+    b = stats['xtwy'] - stats['xtw'] * y_mean
+    coef = linalg.solve(a, b, assume_a='pos')
+    return coef, y_mean - x_mean @ coef
+
+
+def gram_squared_error(stats, coef, intercept):
+    '''
+    :param stats: sufficient statistics of the held out data
+    :param coef: fitted coefficients
+    :param intercept: fitted intercept
+    :return: weighted sum of squared errors of the fit on the held out data
+    '''
+    return stats['wyy'] - 2 * intercept * stats['wy'] - 2 * coef @ stats['xtwy'] + intercept ** 2 * stats['w'] + \
+           2 * intercept * coef @ stats['xtw'] + coef @ (stats['xtx'] @ coef)
+
+
+def fit_rapm_from_shards(paths, registry, name, target='points', lambdas=lambdas_rapm, per_possession=True, folds=5,
+                         processes=1, replacement_threshold=None, exposure_weighted=False):
+    '''
+    :param paths: shard paths
+    :param registry: player registry, must contain every player in the shards
+    :param name: name we want to give the value
+    :param target: target column, or one of the rapm.four_factors names, e.g. 'RA_EFG'
+    :param lambdas: list of lambdas, chosen by cross validation over games like calculate_rapm
+    :param per_possession: if True the target is fit per 100 possessions
+    :param folds: number of cross validation folds
+    :param processes: number of worker processes used to read the shards
+    :param replacement_threshold: optional replacement level threshold, see calculate_rapm
+    :param exposure_weighted: if True the offensive and defensive values are combined weighted by possessions
+    :return: RAPM data frame and intercept, the same as calculate_rapm
+    '''
+    fold_stats = accumulate_shard_folds(paths, len(registry['ids']), target, per_possession, folds, processes)
+    return fit_rapm_from_gram(fold_stats, registry, name, lambdas, replacement_threshold, exposure_weighted)
+
+
+def fit_rapm_from_gram(fold_stats, registry, name, lambdas=lambdas_rapm, replacement_threshold=None,
+                       exposure_weighted=False):
+    '''
+    :param fold_stats: list of sufficient statistics, one per cross validation fold, over the registry's columns
+    :param registry: player registry
+    :param name: name we want to give the value
+    :param lambdas: list of lambdas, chosen by cross validation over the folds
+    :param replacement_threshold: optional replacement level threshold, see calculate_rapm
+    :param exposure_weighted: if True the offensive and defensive values are combined weighted by possessions
+    :return: RAPM data frame and intercept, the same as calculate_rapm
+    '''
+    total = new_gram_stats(len(registry['ids']) * 2)
+    for stats in fold_stats:
+        add_gram_stats(total, stats)
+    played = total['xtx'].diagonal()
+
+    exposure = None
+    column_map = None
+    if replacement_threshold is not None or exposure_weighted:
+        exposure = exposure_table(total['exposure'], registry, replacement_threshold)
+    if replacement_threshold is not None:
+        # Solve the smaller system where the low minute players share one pair of columns
+        column_map = replacement_column_map(exposure['replacement'].values)
+        pool = replacement_pooling_matrix(column_map)
+        fold_stats = [reduce_gram_stats(stats, pool) for stats in fold_stats]
+        total = reduce_gram_stats(total, pool)
+
+    # convert our lambdas to alphas
+    alphas = [lambda_to_alpha(l, total['n']) for l in lambdas]
+    best_alpha = alphas[0]
+    if len(alphas) > 1:
+        errors = []
+        for alpha in alphas:
+            error = 0
+            for stats in fold_stats:
+                if stats['n'] == 0:
+                    continue
+                coef, intercept = solve_gram_ridge(subtract_gram_stats(total, stats), alpha)
+                error += gram_squared_error(stats, coef, intercept)
+            errors.append(error)
+        best_alpha = alphas[int(np.argmin(errors))]
+
+    coef, intercept = solve_gram_ridge(total, best_alpha)
+    if column_map is not None:
+        coef = expand_coefficients(coef, column_map)
+    return rapm_frame(coef, np.array([intercept]), name, registry, played, alpha_to_lambda(best_alpha, total['n']),
+                      exposure, exposure_weighted)
@@ -0,0 +1,163 @@
+import heapq
+import itertools
+import numpy as np
+from player_registry import player_indices
+
+# Lineup matchup scoring on fitted RAPM coefficients.
+# The model says the points per 100 possessions an offensive lineup O scores against a defensive lineup D are
+#     intercept + sum(Off[O]) - sum(Def[D])
+# (defensive columns are -1 in the matrix), so scoring any number of lineups is a gather of the coefficient vectors at
+# the lineups' column ids and a sum over the 5 players, done a chunk of lineups at a time.
+default_chunk_size = 100000
+
+
+def coefficient_vectors(players_coef, name, registry):
+    '''
+    :param players_coef: data frame returned by calculate_rapm
+    :param name: name the value was given in calculate_rapm
+    :param registry: player registry
+    :return: dictionary with the offensive and defensive coefficients indexed by registry column id, and the intercept
+    '''
+    n_players = len(registry['ids'])
+    columns = player_indices(registry, players_coef['playerId'].values)
+    offense = np.zeros(n_players)
+    defense = np.zeros(n_players)
+    offense[columns] = players_coef['{0}__Off'.format(name)].values
+    defense[columns] = players_coef['{0}__Def'.format(name)].values
+    return {
+        'offense': offense,
+        'defense': defense,
+        'intercept': float(players_coef['{0}__intercept'.format(name)].iloc[0])
+    }
+
+
+def expected_points(offense_lineups, defense_lineups, vectors):
+    '''
+    :param offense_lineups: mx5 int array of player column ids
+    :param defense_lineups: kx5 int array of player column ids
+    :param vectors: coefficient vectors
+    :return: mxk matrix of expected points per 100 possessions for each offensive lineup against each defensive lineup
+    '''
+    offense = vectors['offense'][offense_lineups].sum(axis=1)
+    defense = vectors['defense'][defense_lineups].sum(axis=1)
+    return vectors['intercept'] + offense[:, None] - defense[None, :]
+
+
+def net_ratings(lineups, opponents, vectors):
+    '''
+    :param lineups: mx5 int array of player column ids
+    :param opponents: kx5 int array of player column ids
+    :param vectors: coefficient vectors
+    :return: mxk matrix of expected net points per 100 possessions of each lineup against each opponent lineup
+    '''
+    return expected_points(lineups, opponents, vectors) - expected_points(opponents, lineups, vectors).T
+
+
+def player_values(vectors, mode):
+    '''
+    :param vectors: coefficient vectors
+    :param mode: 'offense' (points scored), 'defense' (points prevented) or 'net'
+    :return: what each player adds to a lineup's score in that mode
+    '''
+    if mode == 'offense':
+        return vectors['offense']
+    elif mode == 'defense':
+        return vectors['defense']
+    elif mode == 'net':
+        return vectors['offense'] + vectors['defense']
+    raise ValueError('Unknown mode {}'.format(mode))
+
+
+def opponent_baseline(opponents, vectors, mode, opponent_weights=None):
+    '''
+    :param opponents: kx5 int array of the opponent's likely lineups
+    :param vectors: coefficient vectors
+    :param mode: 'offense', 'defense' or 'net'
+    :param opponent_weights: optional k weights, e.g. minutes played by each opponent lineup
+    :return: the part of the score that only depends on the opponents, averaged over their lineups
+    Lineup score = sum of player_values over the lineup + this baseline
+    '''
+    opponent_offense = np.average(vectors['offense'][opponents].sum(axis=1), weights=opponent_weights)
+    opponent_defense = np.average(vectors['defense'][opponents].sum(axis=1), weights=opponent_weights)
+    if mode == 'offense':
+        # expected points scored
+        return vectors['intercept'] - opponent_defense
+    elif mode == 'defense':
+        # expected points prevented, the negative of points allowed
+        return -(vectors['intercept'] + opponent_offense)
+    elif mode == 'net':
+        return -(opponent_offense + opponent_defense)
+    raise ValueError('Unknown mode {}'.format(mode))
+
+
+def lineup_combinations(roster, size=5, chunk_size=default_chunk_size):
+    '''
+    :param roster: array of player column ids
+    :param size: players per lineup
+    :param chunk_size: lineups per chunk
+    :return: generator of chunk_size x size int arrays covering every combination of the roster
+    '''
+    roster = np.asarray(roster, dtype=np.int32)
+    combos = itertools.combinations(range(len(roster)), size)
+    while True:
+        chunk = np.fromiter(itertools.chain.from_iterable(itertools.islice(combos, chunk_size)), dtype=np.int32)
+        if len(chunk) == 0:
+            return
+        yield roster[chunk.reshape(-1, size)]
+
+
+def score_lineups(lineups, opponents, vectors, mode='net', opponent_weights=None):
+    '''
+    :param lineups: mx5 int array of player column ids, or an iterable of such chunks (e.g. lineup_combinations)
+    :param opponents: kx5 int array of the opponent's likely lineups
+    :param vectors: coefficient vectors
+    :param mode: 'offense' (expected points scored), 'defense' (expected points prevented) or 'net'
+    :param opponent_weights: optional k weights of the opponent lineups
+    :return: generator of (lineups, scores) chunks, scores per 100 possessions averaged over the opponent lineups
+    '''
+    if isinstance(lineups, np.ndarray):
+        lineups = [lineups]
+    values = player_values(vectors, mode)
+    baseline = opponent_baseline(opponents, vectors, mode, opponent_weights)
+    for chunk in lineups:
+        yield chunk, values[chunk].sum(axis=1) + baseline
+
+
+def top_k_lineups(roster, opponents, vectors, k=10, size=5, mode='net', opponent_weights=None):
+    '''
+    :param roster: array of player column ids
+    :param opponents: kx5 int array of the opponent's likely lineups
+    :param vectors: coefficient vectors
+    :param k: number of lineups to return
+    :param size: players per lineup
+    :param mode: 'offense', 'defense' or 'net'
+    :param opponent_weights: optional weights of the opponent lineups
+    :return: k x size array of the best lineups and their scores, best first
+    The score is a sum of player values, so we walk the combinations best first from the top players down and stop
+    after k, instead of scoring every combination of the roster.
+    '''
+    roster = np.asarray(roster, dtype=np.int32)
+    values = player_values(vectors, mode)[roster]
+    order = np.argsort(-values)
+    sorted_values = values[order]
+    baseline = opponent_baseline(opponents, vectors, mode, opponent_weights)
+
+    # Each state is a sorted tuple of positions in the sorted roster. Moving one position down by one gives the next
+    # best combinations, and the heap always pops the best combination not returned yet
+    start = tuple(range(size))
+    heap = [(-sorted_values[list(start)].sum(), start)]
+    seen = {start}
+    lineups = []
+    scores = []
+    while heap and len(lineups) < k:
+        score, positions = heapq.heappop(heap)
+        lineups.append(roster[order[list(positions)]])
+        scores.append(-score + baseline)
+        for i in range(size):
+            limit = positions[i + 1] if i + 1 < size else len(roster)
+            if positions[i] + 1 < limit:
+                successor = positions[:i] + (positions[i] + 1,) + positions[i + 1:]
+                if successor not in seen:
+                    seen.add(successor)
+                    heapq.heappush(heap, (-sorted_values[list(successor)].sum(), successor))
+    return np.array(lineups, dtype=np.int32).reshape(-1, size), np.array(scores)
@@ -0,0 +1,113 @@
+import itertools
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from rapm import possession_player_indices, sparse_design_matrix, solve_sparse_ridge, lambda_to_alpha, rapm_frame
+
+# Lineup synergy RAPM.
+# On top of the offensive and defensive column of every player, each pair of teammates on the floor together gets an
+# offensive and a defensive interaction column, so the model can pick up pairs that play better or worse together than
+# their individual values add up to. Pair columns get their own (stronger) ridge penalty so they only explain what the
+# individual columns can not.
+# Pairs can be encoded exactly (one column per pair seen in the data) or hashed into a fixed number of buckets, which
+# keeps the number of columns bounded no matter how many seasons go in. Either way there are far too many columns for a
+# dense matrix, so it is solved with the sparse conjugate gradient ridge solver instead of RidgeCV.
+lambda_individual = .05
+lambda_pairs = .5
+
+# The 10 teammate pairs in a 5 man lineup, as positions in the lineup
+pair_positions = np.array(list(itertools.combinations(range(5), 2)))
+
+
+def lineup_pair_keys(lineups, n_players):
+    '''
+    :param lineups: nx5 array of player column ids
+    :param n_players: number of players in the registry
+    :return: nx10 int64 array with one key per teammate pair, the same key whatever order the pair is listed in
+    '''
+    lineups = np.sort(lineups, axis=1).astype(np.int64)
+    return lineups[:, pair_positions[:, 0]] * n_players + lineups[:, pair_positions[:, 1]]
+
+
+def hash_pair_keys(keys, n_buckets):
+    '''
+    :param keys: array of pair keys
+    :param n_buckets: number of hash buckets
+    :return: array of bucket numbers
+    '''
+    # Multiplicative hashing, the product is allowed to wrap around
+    return ((keys.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)) % np.uint64(n_buckets)
+
+
+def pair_design_matrix(offense_keys, defense_keys, pair_columns, n_columns):
+    '''
+    :param offense_keys: nx10 array of offensive pair keys
+    :param defense_keys: nx10 array of defensive pair keys
+    :param pair_columns: function from an array of pair keys to pair column numbers
+    :param n_columns: number of pair columns on each side
+    :return: n x 2*n_columns CSR matrix, +1 for offensive pairs and -1 for defensive pairs like the player columns
+    '''
+    n = offense_keys.shape[0]
+    rows = np.repeat(np.arange(n, dtype=np.int32), 20)
+    cols = np.concatenate([pair_columns(offense_keys), pair_columns(defense_keys) + n_columns], axis=1).ravel()
+    vals = np.tile(np.array([1.0] * 10 + [-1.0] * 10), n)
+    # Hashed pairs can collide within a row, the duplicates are summed
+    return sparse.csr_matrix((vals, (rows, cols.astype(np.int64))), shape=(n, n_columns * 2))
+
+
+def fit_synergy_rapm(possessions, target, name, registry, lambda_player=lambda_individual, lambda_pair=lambda_pairs,
+                     n_buckets=None, tol=1e-8):
+    '''
+    :param possessions: possessions data frame with the target column
+    :param target: target column, e.g. 'points per possession'
+    :param name: name we want to give the value
+    :param registry: player registry
+    :param lambda_player: lambda of the player columns
+    :param lambda_pair: lambda of the pair columns
+    :param n_buckets: number of hash buckets for the pair columns on each side, None for one column per observed pair
+    :param tol: relative tolerance of the conjugate gradient solver
+    :return: RAPM data frame like calculate_rapm, intercept, and a data frame of pair synergies for the observed pairs
+    '''
+    n_players = len(registry['ids'])
+    offense, defense = possession_player_indices(possessions, registry)
+    offense_keys = lineup_pair_keys(offense, n_players)
+    defense_keys = lineup_pair_keys(defense, n_players)
+
+    observed = np.unique(np.concatenate([offense_keys.ravel(), defense_keys.ravel()]))
+    if n_buckets is None:
+        pair_columns = lambda keys: np.searchsorted(observed, keys)
+        n_pair_columns = len(observed)
+    else:
+        pair_columns = lambda keys: hash_pair_keys(keys, n_buckets)
+        n_pair_columns = n_buckets
+
+    train_x = sparse.hstack([sparse_design_matrix(offense, defense, n_players),
+                             pair_design_matrix(offense_keys, defense_keys, pair_columns, n_pair_columns)]).tocsr()
+    train_y = possessions[target].values.astype(np.float64)
+    weights = possessions['possessions'].values.astype(np.float64)
+
+    # Separate regularization for the player and the pair columns
+    samples = train_x.shape[0]
+    penalty = np.concatenate([np.full(n_players * 2, lambda_to_alpha(lambda_player, samples)),
+                              np.full(n_pair_columns * 2, lambda_to_alpha(lambda_pair, samples))])
+    coef, intercept = solve_sparse_ridge(train_x, train_y, weights, penalty, tol=tol)
+
+    played = np.abs(train_x[:, 0:n_players * 2]).sum(axis=0)
+    players_coef, intercept = rapm_frame(coef[0:n_players * 2], np.array([intercept]), name, registry, played,
+                                         lambda_player)
+
+    # Synergy of every pair we saw, with how many possessions they played together on each side
+    pair_coef = coef[n_players * 2:]
+    columns = pair_columns(observed).astype(np.int64)
+    offense_count = pd.Series(np.repeat(weights, 10)).groupby(offense_keys.ravel()).sum()
+    defense_count = pd.Series(np.repeat(weights, 10)).groupby(defense_keys.ravel()).sum()
+    pairs = pd.DataFrame({
+        'player1Id': np.array(registry['ids'])[observed // n_players],
+        'player2Id': np.array(registry['ids'])[observed % n_players],
+        '{0}__Pair_Off'.format(name): pair_coef[columns],
+        '{0}__Pair_Def'.format(name): pair_coef[columns + n_pair_columns],
+        'offensive_possessions': offense_count.reindex(observed).fillna(0).values,
+        'defensive_possessions': defense_count.reindex(observed).fillna(0).values
+    })
+    pairs['{0}__Pair'.format(name)] = pairs['{0}__Pair_Off'.format(name)] + pairs['{0}__Pair_Def'.format(name)]
+    return players_coef, intercept, pairs
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from rapm import possession_player_indices, solve_sparse_ridge, lambda_to_alpha
+
+# Multi season RAPM with player development.
+# Pooling seasons (rapm18-21.csv) gives every player one value for the whole window, fitting seasons one at a time
+# throws away what the other seasons say about the same player. Here every player gets one offensive and one defensive
+# column per season they played, all fit together, with a penalty on the change from one of the player's seasons to
+# their next one. A big smoothness lambda pulls a player's seasons towards one pooled value, a small one lets them move
+# like separate single season fits. The ridge penalty of a player is split evenly over their seasons, so with a very big
+# smoothness lambda every player is shrunk like in the pooled fit, however many seasons they played.
+# The matrix only has a few thousand columns but the smoothness penalty is not diagonal, so the system is solved with
+# the sparse conjugate gradient ridge solver and a sparse penalty matrix.
+lambda_multi_season = .05
+lambda_smoothness = .5
+
+
+def season_columns(players, seasons, n_seasons, observed):
+    '''
+    :param players: nx5 array of player column ids
+    :param seasons: n array of season numbers
+    :param n_seasons: number of seasons
+    :param observed: sorted array of the player-season keys that have a column
+    :return: nx5 array of player-season column ids
+    '''
+    keys = players.astype(np.int64) * n_seasons + seasons[:, None]
+    return np.searchsorted(observed, keys)
+
+
+def smoothness_matrix(observed, n_seasons):
+    '''
+    :param observed: sorted array of the player-season keys that have a column
+    :param n_seasons: number of seasons
+    :return: sparse difference matrix with one row per pair of a player's consecutive seasons (+1 for the later
+    season and -1 for the earlier one), skipping over seasons the player did not play
+    '''
+    player = observed // n_seasons
+    # observed is sorted by player then season, so a player's seasons are next to each other in order
+    links = np.nonzero(player[1:] == player[:-1])[0]
+    rows = np.repeat(np.arange(len(links)), 2)
+    cols = np.stack([links + 1, links], axis=1).ravel()
+    vals = np.tile([1.0, -1.0], len(links))
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(len(links), len(observed)))
+
+
+def fit_multi_season_rapm(possessions, target, name, registry, lambda_value=lambda_multi_season,
+                          lambda_smooth=lambda_smoothness, season_column='season', tol=1e-8):
+    '''
+    :param possessions: possessions data frame with a season column and the target column
+    :param target: target column, e.g. 'points per possession'
+    :param name: name we want to give the value
+    :param registry: player registry
+    :param lambda_value: ridge lambda of every player, divided evenly over the player's season columns
+    :param lambda_smooth: lambda of the penalty on the change between a player's consecutive seasons
+    :param season_column: column holding the season label, e.g. '2019-20'. Labels must sort in time order
+    :param tol: relative tolerance of the conjugate gradient solver
+    :return: data frame with one row per player and season, laid out like data/rapm18-21.csv, and the intercept
+    '''
+    season_labels = np.sort(possessions[season_column].astype(str).unique())
+    n_seasons = len(season_labels)
+    seasons = np.searchsorted(season_labels, possessions[season_column].astype(str).values)
+    offense, defense = possession_player_indices(possessions, registry)
+
+    # Only player-seasons that actually played get a column, on each side
+    keys = np.concatenate([offense, defense], axis=1).astype(np.int64) * n_seasons + seasons[:, None]
+    observed = np.unique(keys)
+    n_columns = len(observed)
+    offense_columns = season_columns(offense, seasons, n_seasons, observed)
+    defense_columns = season_columns(defense, seasons, n_seasons, observed)
+
+    n = len(possessions)
+    rows = np.repeat(np.arange(n, dtype=np.int32), 10)
+    cols = np.concatenate([offense_columns, defense_columns + n_columns], axis=1).ravel()
+    vals = np.tile(np.array([1.0] * 5 + [-1.0] * 5), n)
+    train_x = sparse.csr_matrix((vals, (rows, cols)), shape=(n, n_columns * 2))
+    train_y = possessions[target].values.astype(np.float64)
+    weights = possessions['possessions'].values.astype(np.float64)
+
+    # Ridge penalty on every column plus the smoothness penalty D'D within the offensive and defensive blocks.
+    # Each column gets 1 / (seasons of the player) of the ridge penalty, otherwise a player's seasons pulled together
+    # would be shrunk once per season and veterans more than newcomers
+    _, player_columns, player_seasons = np.unique(observed // n_seasons, return_inverse=True, return_counts=True)
+    ridge = lambda_to_alpha(lambda_value, n) / player_seasons[player_columns]
+    differences = smoothness_matrix(observed, n_seasons)
+    smooth = lambda_to_alpha(lambda_smooth, n) * (differences.T @ differences)
+    penalty = sparse.diags(np.concatenate([ridge, ridge]), format='csr') + \
+              sparse.block_diag([smooth, smooth], format='csr')
+    coef, intercept = solve_sparse_ridge(train_x, train_y, weights, penalty, tol=tol)
+
+    players_coef = pd.DataFrame({
+        'playerId': np.array(registry['ids'])[observed // n_seasons],
+        'season': season_labels[observed % n_seasons],
+        '{0}__Off'.format(name): coef[0:n_columns],
+        '{0}__Def'.format(name): coef[n_columns:]
+    })
+    players_coef[name] = players_coef['{0}__Off'.format(name)] + players_coef['{0}__Def'.format(name)]
+
+    # rank the values within each season
+    by_season = players_coef.groupby('season')
+    players_coef['{0}_Rank'.format(name)] = by_season[name].rank(ascending=False)
+    players_coef['{0}__Off_Rank'.format(name)] = by_season['{0}__Off'.format(name)].rank(ascending=False)
+    players_coef['{0}__Def_Rank'.format(name)] = by_season['{0}__Def'.format(name)].rank(ascending=False)
+
+    # add the intercept for reference
+    players_coef['{0}__intercept'.format(name)] = intercept
+    players_coef['primaryKey'] = players_coef['playerId'] + '_' + players_coef['season']
+    return players_coef, np.array([intercept])
@@ -3,6 +3,13 @@ import os
 import pandas as pd
 # Import our play by play utils file
 from pbp_utils import *
+from player_registry import player_index, register_players, save_player_registry
+from design_shards import write_game_shard
+from possession_filters import passes_filters
+from shooting_rates import expected_points_column, add_expected_points, event_expected_points
+
+# Per possession counts the four factor targets are built from (see rapm.four_factors)
+four_factor_count_columns = ['FGA', 'FGM', 'FG3M', 'FTA', 'TOV', 'ORB', 'ORB_CHANCES']
 
 # Set columns and width for easier printing
 pd.set_option('display.max_columns', 500)
@@ -46,6 +53,9 @@ def calculate_time_elapsed_period(row):
 # Players at the start of each period are stored as an string in the dataframe column
 # We need to parse out that string into an array of player Ids
 def split_row(list_str):
+    # Frames straight from api_utils still hold the actual list
+    if not isinstance(list_str, str):
+        return [str(x) for x in list_str]
     return [x.replace('[', '').replace(']', '').strip() for x in list_str.split(',')]
 
 # players on the court need to be updated after every substitution
@@ -115,6 +125,49 @@ def count_points(possession):
                 points[p[player1_team_id]] = extract_points(p)
     return points
 
+# Everything we count per team in a possession: points, luck adjusted points and the four factor numerators and
+# denominators (field goals, threes, free throws, turnovers, offensive rebounds and rebound chances)
+possession_stat_columns = ['points', 'expected_points', 'FGA', 'FGM', 'FG3M', 'FTA', 'TOV', 'REB']
+
+# Count up each team's stats in a single pass over the events of a possession
+# stats is a map where the key is the team id and the value is a map of stat -> count
+def count_possession_stats(possession):
+    has_expected_points = expected_points_column in possession[0]
+    stats = {}
+    previous = None
+    for p in possession:
+        team = None
+        if is_made_shot(p) or is_missed_shot(p) or is_free_throw(p):
+            team = p[player1_team_id]
+        elif is_turnover(p):
+            team = p[player1_id] if is_team_turnover(p) else p[player1_team_id]
+        # Rebounds after a missed first free throw are dead ball rebounds, the ball goes back to the shooter
+        elif is_rebound(p) and not (previous is not None and is_missed_free_throw(previous) and
+                                    not is_last_free_throw(previous)):
+            team = p[player1_id] if is_team_rebound(p) else p[player1_team_id]
+        previous = p
+        if team is None:
+            continue
+
+        if team not in stats:
+            stats[team] = dict.fromkeys(possession_stat_columns, 0)
+        team_stats = stats[team]
+        if is_made_shot(p) or is_missed_shot(p):
+            team_stats['FGA'] += 1
+            if is_made_shot(p):
+                team_stats['FGM'] += 1
+                team_stats['FG3M'] += 1 if is_three(p) else 0
+        elif is_free_throw(p):
+            team_stats['FTA'] += 1
+        elif is_turnover(p):
+            team_stats['TOV'] += 1
+        elif is_rebound(p):
+            team_stats['REB'] += 1
+        team_stats['points'] += extract_points(p)
+        if has_expected_points:
+            team_stats['expected_points'] += p[expected_points_column]
+    return stats
+
 
 # We need to know how many points each shot is worth:
 def extract_points(p):
@@ -168,11 +221,13 @@ def determine_possession_team(p, team1, team2):
 
 
 # Parse out the list of events in a possession into a single possession object
-def parse_possession(possession):
+# If a player registry is passed the possession also carries the registry column id of each player, so the RAPM matrix
+# can be built straight from ints
+def parse_possession(possession, registry=None):
     times_of_events = [p[time_elapsed] for p in possession]
     possession_start = min(times_of_events)
     possession_end = max(times_of_events)
-    points = count_points(possession)
+    stats = count_possession_stats(possession)
     game_id = possession[0]['GAME_ID']
     period = possession[0][period_column]
 
@@ -205,7 +260,8 @@ def parse_possession(possession):
         dplayer3 = possession[0]['TEAM2_PLAYER3']
         dplayer4 = possession[0]['TEAM2_PLAYER4']
         dplayer5 = possession[0]['TEAM2_PLAYER5']
-        points = points[team1_id] if team1_id in points else 0
+        offense_team_id = team1_id
+        defense_team_id = team2_id
     else:
         dplayer1 = possession[0]['TEAM1_PLAYER1']
         dplayer2 = possession[0]['TEAM1_PLAYER2']
@@ -217,12 +273,18 @@ def parse_possession(possession):
         oplayer3 = possession[0]['TEAM2_PLAYER3']
         oplayer4 = possession[0]['TEAM2_PLAYER4']
         oplayer5 = possession[0]['TEAM2_PLAYER5']
-        points = points[team2_id] if team2_id in points else 0
+        offense_team_id = team2_id
+        defense_team_id = team1_id
+
+    offense_stats = stats[offense_team_id] if offense_team_id in stats else dict.fromkeys(possession_stat_columns, 0)
+    defense_stats = stats[defense_team_id] if defense_team_id in stats else dict.fromkeys(possession_stat_columns, 0)
 
 
-    return {
+    parsed = {
         'team1_id': str(team1_id),
         'team2_id': str(team2_id),
+        'offense_team_id': str(offense_team_id),
+        'defense_team_id': str(defense_team_id),
         'offensePlayer1Id': str(oplayer1),
         'offensePlayer2Id': str(oplayer2),
         'offensePlayer3Id': str(oplayer3),
@@ -237,52 +299,260 @@ def parse_possession(possession):
         'period': period,
         'possession_start': possession_start,
         'possession_end': possession_end,
-        'points': points
+        'possessions': 1,
+        'points': offense_stats['points'],
+        'FGA': offense_stats['FGA'],
+        'FGM': offense_stats['FGM'],
+        'FG3M': offense_stats['FG3M'],
+        'FTA': offense_stats['FTA'],
+        'TOV': offense_stats['TOV'],
+        # Offensive rebounds, out of every rebound of the offense's misses (theirs plus the defense's)
+        'ORB': offense_stats['REB'],
+        'ORB_CHANCES': offense_stats['REB'] + defense_stats['REB']
     }
 
-def parse_pbp_to_csv(game_id):
-    '''
-    :param game_id: game id for game to be parsed
-    :return: Saves a CSV of the parsed PBP data
-    '''
-    # determine the directory that this file resides in
-    dirname = os.path.dirname(__file__)
-
-    # generate file path for play by play and players on court data
-    input_play_by_play = os.path.join(dirname, './data/{}_pbp.csv'.format(game_id))
-    input_players_on_court = os.path.join(dirname, './data/{}_players_at_period.csv'.format(game_id))
-    output_path = os.path.join(dirname, './data/{}_possessions.csv'.format(game_id))
-
-    # Read in play by play and fill null description columns with empty string
-    play_by_play = pd.read_csv(input_play_by_play, index_col=False)
+    # Only there when the play by play was prepared with shooting rates
+    if expected_points_column in possession[0]:
+        parsed['expected_points'] = offense_stats['expected_points']
+
+    if registry is not None:
+        for i, p in enumerate([oplayer1, oplayer2, oplayer3, oplayer4, oplayer5]):
+            parsed['offensePlayer{}Index'.format(i + 1)] = player_index(registry, p)
+        for i, p in enumerate([dplayer1, dplayer2, dplayer3, dplayer4, dplayer5]):
+            parsed['defensePlayer{}Index'.format(i + 1)] = player_index(registry, p)
+
+    return parsed
+
+# Player id -> name of every player named in the play by play events
+def play_by_play_player_names(play_by_play):
+    names = {}
+    for id_column, name_column in [(player1_id, 'PLAYER1_NAME'), (player2_id, 'PLAYER2_NAME')]:
+        if name_column in play_by_play.columns:
+            named = play_by_play[[id_column, name_column]].dropna()
+            names.update(zip(named[id_column], named[name_column]))
+    return names
+
+# Add every player who appears in the game to the registry, using the names from the play by play where we have them
+def register_game_players(registry, play_by_play, sub_map):
+    names = play_by_play_player_names(play_by_play)
+    player_ids = [p for teams in sub_map.values() for players in teams.values() for p in players]
+    subs = play_by_play[play_by_play[event_type] == 8]
+    player_ids += subs[player1_id].tolist() + subs[player2_id].tolist()
+    return register_players(registry, player_ids, names)
+
+# Seconds elapsed in the game when a period ends
+def period_end_elapsed(period):
+    if period > 4:
+        return (12 * 60 * 4) + ((period - 4) * 5 * 60)
+    else:
+        return period * 12 * 60
+
+# Add the score and clock at the start of a parsed possession, then add its points to the running score
+# score is a map of team id -> points scored so far in the game
+def add_score_context(parsed, score):
+    offense_score = score.get(parsed['offense_team_id'], 0)
+    defense_score = score.get(parsed['defense_team_id'], 0)
+    period_end = period_end_elapsed(parsed['period'])
+    parsed['offense_score'] = offense_score
+    parsed['defense_score'] = defense_score
+    parsed['score_margin'] = offense_score - defense_score
+    parsed['period_seconds_remaining'] = period_end - parsed['possession_start']
+    # Time left in the game: in regulation the time until the end of the 4th quarter, in overtime the time left in the
+    # current overtime period
+    parsed['game_seconds_remaining'] = max(period_end, period_end_elapsed(4)) - parsed['possession_start']
+    score[parsed['offense_team_id']] = offense_score + parsed['points']
+    return parsed
+
+# Fill null description columns and add the time columns to a play by play data frame
+# With shooting rates (see shooting_rates.py) the expected points of every event are added as well
+def prepare_play_by_play(play_by_play, rates=None):
     play_by_play[home_description] = play_by_play[home_description].fillna("")
     play_by_play[neutral_description] = play_by_play[home_description].fillna("")
     play_by_play[away_description] = play_by_play[away_description].fillna("")
     # Apply the methods for calculating time to add the columns to the dataframe
     play_by_play[time_elapsed] = play_by_play.apply(calculate_time_elapsed, axis=1)
     play_by_play[time_elapsed_period] = play_by_play.apply(calculate_time_elapsed_period, axis=1)
+    if rates is not None:
+        play_by_play = add_expected_points(play_by_play, rates)
+    return play_by_play
 
-    # Read the players at the start of each period
-    players_at_start_of_period = pd.read_csv(input_players_on_court)
-    # convert dataframe into a list of rows. I know there is a better way to do this,
-    # We need to keep track of substitutions as they happen, so maintain a map of players on the court at a given moment
-    # It will be structured as period -> team_id -> players array
+# We need to keep track of substitutions as they happen, so maintain a map of players on the court at a given moment
+# It will be structured as period -> team_id -> players array
+def build_sub_map(players_at_start_of_period):
     sub_map = {}
     # Pre-populate the map with the players at the start of each period
     for row in players_at_start_of_period.iterrows():
         sub_map[row[1][period_column]] = {row[1]['TEAM_ID_1']: split_row(row[1]['TEAM_1_PLAYERS']),
                                           row[1]['TEAM_ID_2']: split_row(row[1]['TEAM_2_PLAYERS'])}
+    return sub_map
+
+def parse_game(play_by_play, players_at_start_of_period, registry=None, filters=None, rates=None):
+    '''
+    :param play_by_play: play by play data frame of one game
+    :param players_at_start_of_period: players on court at the start of each period data frame
+    :param registry: optional player registry, new players are appended to it but it is not saved, see parse_pbp_to_csv
+    :param filters: optional list of predicates from possession_filters. Possessions that fail any of them are dropped
+    before they are added to the data frame
+    :param rates: optional shooting rates of the season, adds the luck adjusted expected_points column
+    :return: data frame of parsed possessions with their score context
+    '''
+    play_by_play = prepare_play_by_play(play_by_play, rates)
+    sub_map = build_sub_map(players_at_start_of_period)
 
+    # New players are only appended to the registry here, the caller saves it
+    if registry is not None:
+        register_game_players(registry, play_by_play, sub_map)
 
     pbp_rows = list(play_by_play.iterrows())
     possessions = parse_possessions(pbp_rows, sub_map)
 
-    # Build a list of parsed possession objects
+    # Build a list of parsed possession objects. The score has to be tracked over every possession, filtered or not
     parsed_possessions = []
+    score = {}
     for possession in possessions:
-        parsed_possessions.append(parse_possession(possession))
+        parsed = add_score_context(parse_possession(possession, registry), score)
+        if filters is None or passes_filters(parsed, filters):
+            parsed_possessions.append(parsed)
 
     # Build a dataframe from the list of parsed possession
-    df = pd.DataFrame(parsed_possessions)
+    return pd.DataFrame(parsed_possessions)
+
+"""
+Streaming possession parser for live games
+The helpers in pbp_utils look at most 20 events back (free throw fouls, missed shots before rebounds) and
+is_and_1 looks at most 19 events past a made shot, only at events within 10 seconds of it. So we keep a window of the
+last events and classify an event as soon as
+1. it is not a made shot, or
+2. 19 more events have arrived, or
+3. an event more than 10 seconds of game time later, or the end of the period, has arrived.
+Only made shots ever wait, and never longer than 10 seconds of game clock or 19 events, so a possession is emitted
+within that bound of its last event.
+"""
+stream_lookback = 20
+stream_lookahead = 19
+
+# Live events come in as dictionaries: fill the descriptions and add the columns prepare_play_by_play adds
+def prepare_event(row, rates=None):
+    for column in [home_description, neutral_description, away_description]:
+        if not isinstance(row.get(column), str):
+            row[column] = ""
+    row[time_elapsed] = calculate_time_elapsed(row)
+    row[time_elapsed_period] = calculate_time_elapsed_period(row)
+    if rates is not None:
+        row[expected_points_column] = event_expected_points(row, rates)
+    return row
+
+def is_event_resolved(window, position):
+    row = window[position]
+    if not is_made_shot(row):
+        return True
+    later = window[position + 1:]
+    if len(later) >= stream_lookahead:
+        return True
+    for r in later:
+        if is_end_of_period(r) or r[time_elapsed] > row[time_elapsed] + 10:
+            return True
+    return False
+
+def stream_possessions(events, sub_map, registry=None, filters=None, load_period=None, rates=None):
+    '''
+    :param events: iterable of play by play rows (dictionaries or Series) in game order, e.g. from
+    api_utils.poll_pbp_events
+    :param sub_map: period -> team_id -> players array, see build_sub_map. Periods can be added as the game goes
+    :param registry: optional player registry, new players are appended to it but it is not saved, see parse_pbp_to_csv
+    :param filters: optional list of possession filter predicates, see parse_game
+    :param load_period: optional function period -> {team_id: players array}, called for periods missing from sub_map
+    :param rates: optional shooting rates of the season, adds the luck adjusted expected_points column
+    :return: generator of parsed possessions with their score context, yielded as soon as they can be classified
+    '''
+    window = []
+    # position in the window of the first event that has not been classified yet
+    position = 0
+    current_possession = []
+    score = {}
+
+    if registry is not None:
+        register_players(registry, [p for teams in sub_map.values() for players in teams.values() for p in players])
+
+    events = iter(events)
+    final = False
+    while not final:
+        row = next(events, None)
+        if row is None:
+            # End of the game, everything left can be classified with what we have
+            final = True
+        else:
+            window.append(prepare_event(row, rates))
+
+        ended = []
+        while position < len(window) and (final or is_event_resolved(window, position)):
+            row = window[position]
+            period = row[period_column]
+            if period not in sub_map and load_period is not None:
+                sub_map[period] = load_period(period)
+                if registry is not None:
+                    register_players(registry, [p for players in sub_map[period].values() for p in players])
+            if registry is not None and is_substitution(row):
+                register_players(registry, [row[player2_id]], {row[player2_id]: row.get('PLAYER2_NAME', '')})
+            # Same steps as parse_possessions, one event at a time
+            update_subs(row, sub_map)
+            if not is_substitution(row) and not is_end_of_period(row):
+                current_possession.append(row)
+            if is_end_of_possession(position, row, list(enumerate(window))):
+                if len(current_possession) > 0:
+                    ended.append(current_possession)
+                current_possession = []
+            position += 1
+
+        # Only keep as many classified events as the helpers look back
+        drop = max(0, position - stream_lookback)
+        window = window[drop:]
+        position -= drop
+
+        for possession in ended:
+            parsed = add_score_context(parse_possession(possession, registry), score)
+            if filters is None or passes_filters(parsed, filters):
+                yield parsed
+
+def parse_pbp_to_csv(game_id, registry=None, shard_directory=None, filters=None, output_suffix='', rates=None):
+    '''
+    :param game_id: game id for game to be parsed
+    :param registry: optional player registry. New players are appended to it (and the registry is saved back to the
+    file it was loaded from) and each possession carries the int column id of its players next to the player id strings
+    :param shard_directory: optional folder to also save the game as a design matrix shard in (needs the registry)
+    :param filters: optional list of possession filter predicates, see parse_game
+    :param output_suffix: added to the output file name, so filtered possessions do not overwrite the full set. Their
+    shards are saved in a sub folder of shard_directory named after it
+    :param rates: optional shooting rates of the season, adds the luck adjusted expected_points column
+    :return: Saves a CSV of the parsed PBP data
+    '''
+    # Shards store registry column ids, check before doing any parsing
+    if shard_directory is not None and registry is None:
+        raise ValueError('Saving a shard needs the player registry, e.g. player_registry.load_player_registry()')
+
+    # determine the directory that this file resides in
+    dirname = os.path.dirname(__file__)
+
+    # generate file path for play by play and players on court data
+    input_play_by_play = os.path.join(dirname, './data/{}_pbp.csv'.format(game_id))
+    input_players_on_court = os.path.join(dirname, './data/{}_players_at_period.csv'.format(game_id))
+    output_path = os.path.join(dirname, './data/{}_possessions{}.csv'.format(game_id, output_suffix))
+
+    # Read in play by play and the players at the start of each period
+    play_by_play = pd.read_csv(input_play_by_play, index_col=False)
+    players_at_start_of_period = pd.read_csv(input_players_on_court)
+
+    players_before = len(registry['ids']) if registry is not None else 0
+    df = parse_game(play_by_play, players_at_start_of_period, registry, filters, rates)
+    # Column ids are append-only, so save the registry before anything is written with the new ids
+    if registry is not None and len(registry['ids']) > players_before and registry['path'] is not None:
+        save_player_registry(registry)
+
+    df.to_csv(output_path, index=False)
 
-    df.to_csv(output_path, index=False)
\ No newline at end of file
+    if shard_directory is not None and len(df) > 0:
+        columns = [c for c in ['points', 'expected_points'] + four_factor_count_columns if c in df.columns]
+        # Filtered possessions go in their own folder, so list_shards(shard_directory) only finds every game once
+        if output_suffix:
+            shard_directory = os.path.join(shard_directory, output_suffix)
+        write_game_shard(df, game_id, registry, columns, shard_directory)
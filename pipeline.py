@@ -0,0 +1,154 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from api_utils import extract_data, get_pbp_url, get_players_on_court_at_start_of_period_df
+from parse_pbp import parse_game, play_by_play_player_names, four_factor_count_columns
+from player_registry import player_indices, register_players, save_player_registry
+from rapm import offense_columns, defense_columns, sparse_design_matrix, lambdas_rapm
+from design_shards import new_gram_stats, resize_gram_stats, accumulate_matrix, fit_rapm_from_gram, write_game_shard, \
+    possession_shard, shard_target, accumulate_exposure
+
+# Streaming season build.
+# Instead of downloading every game (make_pbp_csv), then parsing every game (parse_pbp_to_csv), then fitting (rapm.py),
+# the three stages run at the same time:
+#   fetch threads  -> raw game frames  -> parse processes -> parsed possessions -> one accumulator
+# Fetching waits on the network so threads are enough, parsing is pure python so it runs in worker processes, and the
+# accumulator in the main process owns the player registry and adds each game into the Gram matrix of the fit.
+# The queue between fetching and parsing and the number of games being parsed at once are both bounded, so a slow
+# stage makes the stage before it wait instead of piling games up in memory.
+
+# Room for this many players is added to the Gram statistics at a time, so every new player does not resize them
+registry_growth = 128
+
+
+def fetch_game(game_id):
+    '''
+    :param game_id: game id
+    :return: play by play data frame and players on court at the start of each period data frame
+    '''
+    play_by_play = extract_data(get_pbp_url(game_id))
+    players_at_start_of_period = get_players_on_court_at_start_of_period_df(game_id, play_by_play.copy())
+    return play_by_play, players_at_start_of_period
+
+
+def parse_fetched_game(game_id, play_by_play, players_at_start_of_period, filters=None, rates=None):
+    '''
+    :return: game id, parsed possessions data frame and player id -> name of the players in the game. Runs in a
+    worker process, so it does not touch the registry. Possessions failing the filters are dropped while parsing, so
+    they are never sent back to the accumulator
+    '''
+    possessions = parse_game(play_by_play, players_at_start_of_period, filters=filters, rates=rates)
+    return game_id, possessions, play_by_play_player_names(play_by_play)
+
+
+def fetch_games(game_ids, raw_games, failed, fetch_workers):
+    '''
+    :param game_ids: queue of game ids to fetch
+    :param raw_games: bounded queue the fetched games are put on, followed by None once every game is fetched
+    :param failed: list the ids of games that could not be fetched are added to
+    :param fetch_workers: number of fetch threads
+    '''
+    def worker():
+        while True:
+            try:
+                game_id = game_ids.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                raw_games.put((game_id,) + fetch_game(game_id))
+            except Exception as e:
+                failed.append((game_id, repr(e)))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(fetch_workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    raw_games.put(None)
+
+
+def run_pipeline(game_ids, registry, name='RAPM', target='points', lambdas=lambdas_rapm, fetch_workers=4,
+                 parse_workers=None, queue_size=8, folds=5, filters=None, shard_directory=None, rates=None,
+                 replacement_threshold=None, exposure_weighted=False):
+    '''
+    :param game_ids: list of game ids to build, e.g. from api_utils.generate_game_id_list
+    :param registry: player registry, new players are appended and saved back to the file it was loaded from
+    :param name: name we want to give the value
+    :param target: target column, fit per 100 possessions. 'expected_points' for luck adjusted RAPM (needs rates), or
+    one of the rapm.four_factors names, e.g. 'RA_EFG', like fit_rapm_from_shards
+    :param lambdas: list of lambdas, chosen by cross validation over games
+    :param fetch_workers: number of threads downloading games
+    :param parse_workers: number of processes parsing games, defaults to the number of CPUs
+    :param queue_size: most games waiting to be parsed, and most games being parsed, at any time
+    :param folds: number of cross validation folds, games are assigned round robin
+    :param filters: optional list of possession filter predicates from possession_filters, applied by the parse workers
+    :param shard_directory: optional folder to also save every game as a design matrix shard in
+    :param rates: optional shooting rates of the season, see shooting_rates.py
+    :param replacement_threshold: optional replacement level threshold, see calculate_rapm
+    :param exposure_weighted: if True the offensive and defensive values are combined weighted by possessions
+    :return: RAPM data frame, intercept, and a list of (game id, error) for games that could not be built
+    '''
+    n_players = len(registry['ids']) + registry_growth
+    fold_stats = [new_gram_stats(n_players * 2) for _ in range(folds)]
+    failed = []
+    games_added = 0
+
+    def accumulate(game_id, future):
+        nonlocal n_players, fold_stats, games_added
+        try:
+            game_id, possessions, names = future.result()
+        except Exception as e:
+            failed.append((game_id, repr(e)))
+            return
+        if len(possessions) == 0:
+            return
+        if register_players(registry, possessions[offense_columns + defense_columns].values.ravel(), names) > 0:
+            # Saved before the game's shard is written with the new column ids
+            if registry['path'] is not None:
+                save_player_registry(registry)
+            if len(registry['ids']) > n_players:
+                # Grow by a fixed block of players, the statistics only hold the rows of players who played
+                new_players = len(registry['ids']) + registry_growth
+                fold_stats = [resize_gram_stats(stats, n_players, new_players) for stats in fold_stats]
+                n_players = new_players
+        if shard_directory is not None:
+            columns = [c for c in ['points', 'expected_points'] + four_factor_count_columns if c in possessions.columns]
+            write_game_shard(possessions, game_id, registry, columns, shard_directory)
+
+        offense = player_indices(registry, possessions[offense_columns].values)
+        defense = player_indices(registry, possessions[defense_columns].values)
+        # Same targets and weights as the fit from shards
+        shard = possession_shard(possessions, target)
+        y, w, keep = shard_target(shard, target, True)
+        x = sparse_design_matrix(offense, defense, n_players)
+        accumulate_matrix(fold_stats[games_added % folds], x[keep], y[keep], w[keep])
+        accumulate_exposure(fold_stats[games_added % folds], x, shard['weights'])
+        games_added += 1
+
+    game_queue = queue.Queue()
+    for game_id in game_ids:
+        game_queue.put(game_id)
+    raw_games = queue.Queue(maxsize=queue_size)
+    fetcher = threading.Thread(target=fetch_games, args=(game_queue, raw_games, failed, fetch_workers), daemon=True)
+    fetcher.start()
+
+    in_flight = deque()
+    with ProcessPoolExecutor(parse_workers) as pool:
+        while True:
+            game = raw_games.get()
+            if game is None:
+                break
+            in_flight.append((game[0], pool.submit(parse_fetched_game, *game, filters=filters, rates=rates)))
+            # Backpressure: wait for the oldest game before taking more off the fetch queue
+            while len(in_flight) >= queue_size:
+                accumulate(*in_flight.popleft())
+        while len(in_flight) > 0:
+            accumulate(*in_flight.popleft())
+    fetcher.join()
+
+    # Trim the statistics to the final registry size before solving
+    fold_stats = [resize_gram_stats(stats, n_players, len(registry['ids'])) for stats in fold_stats]
+    players_coef, intercept = fit_rapm_from_gram(fold_stats, registry, name, lambdas, replacement_threshold,
+                                                 exposure_weighted)
+    return players_coef, intercept, failed
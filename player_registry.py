@@ -0,0 +1,125 @@
+# Import os for relative pathing to data
+import os
+import numpy as np
+import pandas as pd
+
+# The player registry maps an NBA player id to a fixed column id in the RAPM matrix.
+# A player's column id is their row in the registry file. Players are only ever appended, never re-sorted or removed,
+# so a column id stays valid across seasons and runs and coefficient vectors / Gram matrices from different fits line
+# up without any re-mapping.
+registry_path = os.path.join(os.path.dirname(__file__), 'data', 'player_names.csv')
+
+
+def player_key(player_id):
+    '''
+    :param player_id: player id as int, float or string (203124, 203124.0, '203124')
+    :return: string, the canonical form of the id used as the registry key
+    '''
+    return str(int(float(player_id)))
+
+
+def new_player_registry(path=None):
+    '''
+    :param path: optional path of the registry csv, where save_player_registry writes it
+    :return: an empty registry. It is a dictionary with the list of player ids in column order, their names, a
+    lookup from player id to column id and the path it is saved to
+    '''
+    return {'ids': [], 'names': [], 'lookup': {}, 'path': path}
+
+
+def load_player_registry(path=registry_path):
+    '''
+    :param path: path to the registry csv (playerId, playerName and optionally playerIndex)
+    :return: player registry, empty if the file does not exist yet. It is saved back to the same path
+    '''
+    registry = new_player_registry(path)
+    if not os.path.exists(path):
+        return registry
+    frame = pd.read_csv(path, dtype={'playerId': str, 'playerName': str}, keep_default_na=False)
+    # Older files have no index column, in that case the row order is the column order
+    if 'playerIndex' in frame.columns:
+        frame = frame.sort_values('playerIndex')
+    register_players(registry, frame['playerId'].tolist(), frame['playerName'].tolist())
+    return registry
+
+
+def save_player_registry(registry, path=None):
+    '''
+    :param registry: player registry
+    :param path: path to write the registry csv to, defaults to the path the registry was loaded from
+    :return: Saves the registry as a CSV with its column ids
+    '''
+    if path is None:
+        path = registry['path']
+    if path is None:
+        raise ValueError('The registry was not loaded from a file, pass the path to save it to')
+    # The registry is the only record of the column ids, so write a temporary file and swap it in, a crash half way
+    # through the write can not leave a truncated registry behind
+    temporary_path = '{}.tmp'.format(path)
+    registry_frame(registry).to_csv(temporary_path, index=False)
+    os.replace(temporary_path, path)
+
+
+def registry_frame(registry):
+    '''
+    :param registry: player registry
+    :return: data frame of playerIndex, playerId and playerName, one row per column id
+    '''
+    return pd.DataFrame({
+        'playerIndex': np.arange(len(registry['ids']), dtype=np.int32),
+        'playerId': registry['ids'],
+        'playerName': registry['names']
+    })
+
+
+def register_players(registry, player_ids, names=None):
+    '''
+    :param registry: player registry
+    :param player_ids: iterable of player ids
+    :param names: optional list of names lined up with player_ids, or a dictionary of player id -> name
+    :return: the number of players appended to the registry
+    '''
+    if names is None:
+        names = {}
+    elif not isinstance(names, dict):
+        names = dict(zip([player_key(p) for p in player_ids], names))
+    else:
+        names = {player_key(k): v for k, v in names.items()}
+
+    added = 0
+    for player_id in player_ids:
+        key = player_key(player_id)
+        if key in registry['lookup']:
+            # Fill in a name we did not know when the player was first registered
+            index = registry['lookup'][key]
+            if not registry['names'][index] and names.get(key):
+                registry['names'][index] = names[key]
+            continue
+        registry['lookup'][key] = len(registry['ids'])
+        registry['ids'].append(key)
+        registry['names'].append(names.get(key, ''))
+        added += 1
+    return added
+
+
+def player_index(registry, player_id):
+    '''
+    :param registry: player registry
+    :param player_id: player id
+    :return: int, the column id of the player. Raises KeyError for players not in the registry
+    '''
+    return registry['lookup'][player_key(player_id)]
+
+
+def player_indices(registry, player_ids):
+    '''
+    :param registry: player registry
+    :param player_ids: array-like of player ids (any shape)
+    :return: int32 numpy array of column ids with the same shape. Raises KeyError for players not in the registry
+    '''
+    player_ids = np.asarray(player_ids)
+    keys = pd.Series(player_ids.ravel()).map(player_key)
+    indices = keys.map(registry['lookup'])
+    if indices.isnull().any():
+        raise KeyError('Players missing from registry: {}'.format(sorted(set(keys[indices.isnull()]))))
+    return indices.values.astype(np.int32).reshape(player_ids.shape)
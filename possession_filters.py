@@ -0,0 +1,89 @@
+from functools import partial
+import numpy as np
+
+# Possession filters.
+# Each filter is a predicate on a parsed possession that uses the score context columns the parser adds
+# (score_margin, game_seconds_remaining, period, ...). The predicates only use comparisons and & / |, so the same
+# function works on a single parsed possession dictionary inside the parser and on a whole possessions data frame.
+# The factories return partials of module level functions rather than lambdas, so filters can be pickled and sent to
+# the parse worker processes of pipeline.py.
+
+# Garbage time: 4th quarter possessions where the margin is at least this big with this many seconds or fewer left
+garbage_time_thresholds = [(720, 25), (540, 20), (360, 10)]
+
+
+def is_garbage_time(thresholds=garbage_time_thresholds):
+    '''
+    :param thresholds: list of (seconds remaining, margin) pairs
+    :return: predicate, true for garbage time possessions
+    '''
+    return partial(garbage_time_predicate, thresholds=thresholds)
+
+
+def garbage_time_predicate(p, thresholds):
+    garbage = False
+    for seconds, margin in thresholds:
+        garbage = garbage | ((p['game_seconds_remaining'] <= seconds) & (np.abs(p['score_margin']) >= margin))
+    return (p['period'] == 4) & garbage
+
+
+def not_garbage_time(thresholds=garbage_time_thresholds):
+    '''
+    :param thresholds: list of (seconds remaining, margin) pairs
+    :return: predicate, true for possessions that are not garbage time
+    '''
+    return partial(not_garbage_time_predicate, thresholds=thresholds)
+
+
+def not_garbage_time_predicate(p, thresholds):
+    return np.logical_not(garbage_time_predicate(p, thresholds))
+
+
+def clutch(seconds=300, margin=5):
+    '''
+    :param seconds: seconds remaining in the 4th quarter or overtime
+    :param margin: largest score margin
+    :return: predicate, true for clutch possessions (by default the last 5 minutes within 5 points)
+    '''
+    return partial(clutch_predicate, seconds=seconds, margin=margin)
+
+
+def clutch_predicate(p, seconds, margin):
+    return (p['period'] >= 4) & (p['game_seconds_remaining'] <= seconds) & (np.abs(p['score_margin']) <= margin)
+
+
+def margin_between(low, high):
+    '''
+    :param low: lowest score margin, from the offense's point of view
+    :param high: highest score margin
+    :return: predicate, true for possessions that start with the margin in [low, high]
+    '''
+    return partial(margin_between_predicate, low=low, high=high)
+
+
+def margin_between_predicate(p, low, high):
+    return (p['score_margin'] >= low) & (p['score_margin'] <= high)
+
+
+def passes_filters(parsed, filters):
+    '''
+    :param parsed: parsed possession dictionary
+    :param filters: list of predicates
+    :return: True if the possession passes every predicate
+    '''
+    for predicate in filters:
+        if not predicate(parsed):
+            return False
+    return True
+
+
+def filter_possessions(possessions, filters):
+    '''
+    :param possessions: parsed possessions data frame with the score context columns
+    :param filters: list of predicates
+    :return: the possessions that pass every predicate
+    '''
+    mask = np.ones(len(possessions), dtype=bool)
+    for predicate in filters:
+        mask &= np.asarray(predicate(possessions), dtype=bool)
+    return possessions[mask]
@@ -0,0 +1,188 @@
+import itertools
+import numpy as np
+import pandas as pd
+from player_registry import player_index
+from rapm import possession_player_indices
+
+# Possession index for lineup, on/off and player combination queries.
+# For every player we keep the sorted row numbers of the possessions they were on offense for and on defense for
+# (one posting list per side, stored back to back in a single array like a CSR matrix). A query like
+# "A and B on, C off, vs team X in the 4th" is then an intersection of a few sorted arrays followed by a lookup of the
+# points and possessions of the rows that are left, instead of a filter over ten player id columns.
+
+
+def build_posting_lists(players, n_players):
+    '''
+    :param players: nx5 array of player column ids
+    :param n_players: number of players in the registry
+    :return: rows array and starts array. The rows of player i are rows[starts[i]:starts[i + 1]], sorted
+    '''
+    flat_players = players.ravel()
+    flat_rows = np.repeat(np.arange(players.shape[0], dtype=np.int32), players.shape[1])
+    # A stable sort on the player keeps the rows of each player in order
+    order = np.argsort(flat_players, kind='stable')
+    starts = np.zeros(n_players + 1, dtype=np.int64)
+    starts[1:] = np.cumsum(np.bincount(flat_players, minlength=n_players))
+    return flat_rows[order], starts
+
+
+def build_possession_index(possessions, registry):
+    '''
+    :param possessions: parsed possessions data frame, any number of games or seasons
+    :param registry: player registry
+    :return: possession index
+    '''
+    n_players = len(registry['ids'])
+    offense, defense = possession_player_indices(possessions, registry)
+    offense_rows, offense_starts = build_posting_lists(offense, n_players)
+    defense_rows, defense_starts = build_posting_lists(defense, n_players)
+    index = {
+        'registry': registry,
+        'n': len(possessions),
+        'offense_rows': offense_rows,
+        'offense_starts': offense_starts,
+        'defense_rows': defense_rows,
+        'defense_starts': defense_starts,
+        'points': possessions['points'].values.astype(np.float64),
+        'possessions': possessions['possessions'].values.astype(np.float64) if 'possessions' in possessions.columns
+        else np.ones(len(possessions)),
+        'period': possessions['period'].values.astype(np.int8),
+    }
+    # Team filters need the team columns, which Ryan's possession files do not have
+    if 'offense_team_id' in possessions.columns:
+        index['offense_team'] = possessions['offense_team_id'].astype(str).values
+        index['defense_team'] = possessions['defense_team_id'].astype(str).values
+    return index
+
+
+def player_rows(index, side, player_id):
+    '''
+    :param index: possession index
+    :param side: 'offense' or 'defense'
+    :param player_id: player id
+    :return: sorted rows of the possessions the player was on the floor for on that side
+    '''
+    i = player_index(index['registry'], player_id)
+    starts = index['{}_starts'.format(side)]
+    if i + 1 >= len(starts):
+        # Registered after the index was built, so not in any of these possessions
+        return np.zeros(0, dtype=np.int32)
+    return index['{}_rows'.format(side)][starts[i]:starts[i + 1]]
+
+
+def in_sorted(rows, other):
+    '''
+    :param rows: sorted array of rows
+    :param other: sorted array of rows
+    :return: boolean mask of the elements of rows that are also in other
+    '''
+    if len(other) == 0:
+        return np.zeros(len(rows), dtype=bool)
+    positions = np.minimum(np.searchsorted(other, rows), len(other) - 1)
+    return other[positions] == rows
+
+
+def select_rows(index, side, on=(), off=(), team=None, opponent=None, period=None):
+    '''
+    :param index: possession index
+    :param side: 'offense' or 'defense', which side the on players are on
+    :param on: player ids that must be on the floor
+    :param off: player ids that must not be on the floor
+    :param team: only possessions of this team on the given side
+    :param opponent: only possessions against this team
+    :param period: only possessions in this period
+    :return: sorted rows of the matching possessions
+    '''
+    # Intersect the shortest posting lists first so the arrays we search shrink as fast as possible
+    lists = sorted([player_rows(index, side, p) for p in on], key=len)
+    if len(lists) > 0:
+        rows = lists[0]
+        for other in lists[1:]:
+            rows = rows[in_sorted(rows, other)]
+    else:
+        rows = np.arange(index['n'], dtype=np.int32)
+    for p in off:
+        rows = rows[~in_sorted(rows, player_rows(index, 'offense', p))]
+        rows = rows[~in_sorted(rows, player_rows(index, 'defense', p))]
+
+    if period is not None:
+        rows = rows[index['period'][rows] == period]
+    if team is not None or opponent is not None:
+        if 'offense_team' not in index:
+            raise ValueError('Possessions have no offense_team_id/defense_team_id columns to filter teams on')
+        other_side = 'defense' if side == 'offense' else 'offense'
+        if team is not None:
+            rows = rows[index['{}_team'.format(side)][rows] == str(team)]
+        if opponent is not None:
+            rows = rows[index['{}_team'.format(other_side)][rows] == str(opponent)]
+    return rows
+
+
+def rows_rating(index, rows):
+    '''
+    :param index: possession index
+    :param rows: rows of possessions
+    :return: points, possessions and points per 100 possessions of the rows
+    '''
+    points = index['points'][rows].sum()
+    possessions = index['possessions'][rows].sum()
+    rating = 100 * points / possessions if possessions > 0 else np.nan
+    return points, possessions, rating
+
+
+def query_lineup(index, on=(), off=(), team=None, opponent=None, period=None):
+    '''
+    :param index: possession index
+    :param on: player ids that must be on the floor, all on the same team
+    :param off: player ids that must not be on the floor
+    :param team: team the on players play for, needed for off court splits where there are no on players
+    :param opponent: only possessions against this team
+    :param period: only possessions in this period
+    :return: dictionary with points, possessions and the offensive, defensive and net rating per 100 possessions
+    '''
+    offense = select_rows(index, 'offense', on, off, team, opponent, period)
+    defense = select_rows(index, 'defense', on, off, team, opponent, period)
+    off_points, off_possessions, off_rating = rows_rating(index, offense)
+    def_points, def_possessions, def_rating = rows_rating(index, defense)
+    return {
+        'offensive_points': off_points,
+        'offensive_possessions': off_possessions,
+        'offensive_rating': off_rating,
+        'defensive_points': def_points,
+        'defensive_possessions': def_possessions,
+        'defensive_rating': def_rating,
+        'net_rating': off_rating - def_rating
+    }
+
+
+def on_off_split(index, player_id, team):
+    '''
+    :param index: possession index
+    :param player_id: player id
+    :param team: team id of the player, possessions of other teams are ignored
+    :return: data frame with the on court and off court ratings of the player
+    '''
+    on = query_lineup(index, on=[player_id], team=team)
+    off = query_lineup(index, off=[player_id], team=team)
+    return pd.DataFrame([on, off], index=['on', 'off'])
+
+
+def combination_ratings(index, player_ids, size=2, min_possessions=0, team=None, opponent=None, period=None):
+    '''
+    :param index: possession index
+    :param player_ids: pool of player ids, usually a roster
+    :param size: number of players in each combination, 2 for two man combos, 5 for lineups
+    :param min_possessions: drop combinations with fewer offensive plus defensive possessions than this
+    :param team: only possessions of this team
+    :param opponent: only possessions against this team
+    :param period: only possessions in this period
+    :return: data frame with one row of ratings per player combination
+    '''
+    ratings = []
+    for combo in itertools.combinations(player_ids, size):
+        rating = query_lineup(index, on=combo, team=team, opponent=opponent, period=period)
+        if rating['offensive_possessions'] + rating['defensive_possessions'] < max(min_possessions, 1):
+            continue
+        rating['players'] = combo
+        ratings.append(rating)
+    return pd.DataFrame(ratings)
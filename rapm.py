@@ -1,6 +1,9 @@
 import numpy as np
 import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator, cg
 from sklearn.linear_model import RidgeCV
+from player_registry import load_player_registry, registry_frame, player_indices
 
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.width', 1000)
@@ -8,6 +11,16 @@ pd.set_option('display.width', 1000)
 # a list of lambdas for cross validation
 lambdas_rapm = [.01, .05, .1]
 
+# Players with fewer possessions than this (offense plus defense) share one replacement level offensive and defensive
+# column instead of getting their own, see replacement_column_map
+replacement_level_possessions = 250
+
+# Player id and registry column id columns of the parsed possessions
+offense_columns = ['offensePlayer1Id', 'offensePlayer2Id', 'offensePlayer3Id', 'offensePlayer4Id', 'offensePlayer5Id']
+defense_columns = ['defensePlayer1Id', 'defensePlayer2Id', 'defensePlayer3Id', 'defensePlayer4Id', 'defensePlayer5Id']
+offense_index_columns = [c.replace('Id', 'Index') for c in offense_columns]
+defense_index_columns = [c.replace('Id', 'Index') for c in defense_columns]
+
 
 def build_player_list(posessions):
     '''
@@ -34,63 +47,171 @@ def adjust_to_per_poss(possessions, column):
     '''
     cpp = column
     cpp += ' per possession'
-    possessions[cpp] = 100 * possessions[column] / possessions[possessions]
+    possessions[cpp] = 100 * possessions[column] / possessions['possessions']
     return possessions
 
-# Will need to convert player ids into dummy variable row for the training matrix
-def map_players(row_in, players):
+# Four factor targets, name -> (count columns and their weights, denominator column), from the per possession counts
+# the parser emits. The denominator is also the sample weight, e.g. RA_EFG is fit on eFG% weighted by field goal attempts
+four_factors = {
+    'RA_EFG': ({'FGM': 1.0, 'FG3M': 0.5}, 'FGA'),
+    'RA_TOV': ({'TOV': 1.0}, 'possessions'),
+    'RA_ORBD': ({'ORB': 1.0}, 'ORB_CHANCES'),
+    'RA_FTR': ({'FTA': 1.0}, 'FGA')
+}
+
+def four_factor_counts(possessions, name):
     '''
-    :param row_in: player id row
-    :param players: player list
-    :return: matrix containing appropriate dummy variables for each player id on each possession
+    :param possessions: possession data frame, or dictionary of arrays, with the four factor count columns
+    :param name: one of the four_factors names
+    :return: numerator and denominator of the factor for every possession
     '''
-    p1 = row_in[0]
-    p2 = row_in[1]
-    p3 = row_in[2]
-    p4 = row_in[3]
-    p5 = row_in[4]
-    p6 = row_in[5]
-    p7 = row_in[6]
-    p8 = row_in[7]
-    p9 = row_in[8]
-    p10 = row_in[9]
-
-    rowOut = np.zeros([len(players) * 2])
-
-    rowOut[players.index(p1)] = 1
-    rowOut[players.index(p2)] = 1
-    rowOut[players.index(p3)] = 1
-    rowOut[players.index(p4)] = 1
-    rowOut[players.index(p5)] = 1
-
-    rowOut[players.index(p6) + len(players)] = -1
-    rowOut[players.index(p7) + len(players)] = -1
-    rowOut[players.index(p8) + len(players)] = -1
-    rowOut[players.index(p9) + len(players)] = -1
-    rowOut[players.index(p10) + len(players)] = -1
+    numerator, denominator = four_factors[name]
+    counts = sum(weight * possessions[column] for column, weight in numerator.items())
+    return counts, possessions[denominator]
 
-    return rowOut
-
-def generate_pbp_matrix(possessions, name, players):
+def four_factor_possessions(possessions, name):
+    '''
+    :param possessions: possession data frame with the four factor count columns
+    :param name: one of the four_factors names
+    :return: the possessions where the factor's denominator is not 0, with the factor per 100 in a column named after
+    it and the denominator as the possessions weight, ready for generate_pbp_matrix and calculate_rapm
+    '''
+    counts, denominator = four_factor_counts(possessions, name)
+    keep = denominator > 0
+    factor = possessions[keep].copy()
+    factor[name] = 100 * counts[keep] / denominator[keep]
+    factor['possessions'] = denominator[keep]
+    return factor
+
+def possession_player_indices(possessions, registry):
+    '''
+    :param possessions: Parsed possessions data frame
+    :param registry: player registry
+    :return: two nx5 int32 arrays with the registry column ids of the offensive and defensive players
+    '''
+    # The parser already emits the column ids when it was run with the registry, otherwise look the ids up
+    if all(c in possessions.columns for c in offense_index_columns + defense_index_columns):
+        return possessions[offense_index_columns].values.astype(np.int32), \
+               possessions[defense_index_columns].values.astype(np.int32)
+    return player_indices(registry, possessions[offense_columns].values), \
+           player_indices(registry, possessions[defense_columns].values)
+
+def generate_pbp_matrix(possessions, name, registry):
     '''
     :param possessions: Parsed possessions file
     :param name: name
-    :param players: players list
+    :param registry: player registry
     :return: possession matrix for RAPM calculation
     '''
-    # Player IDs into matrix
-    x_base = possessions.as_matrix(columns=['offensePlayer1Id', 'offensePlayer2Id',
-                                                   'offensePlayer3Id', 'offensePlayer4Id', 'offensePlayer5Id',
-                                                   'defensePlayer1Id', 'defensePlayer2Id', 'defensePlayer3Id',
-                                                   'defensePlayer4Id', 'defensePlayer5Id'])
-    # Map matrix to base using Ryan's mapping function
-    x_rows = np.apply_along_axis(map_players, 1, x_base, players)
+    n_players = len(registry['ids'])
+    offense, defense = possession_player_indices(possessions, registry)
+    # Dummy variables set for every row at once from the column ids: 1 for the offensive players' columns, -1 for the
+    # defensive players' columns, which are offset by the size of the registry
+    x_rows = np.zeros([len(possessions), n_players * 2])
+    rows = np.arange(len(possessions))[:, None]
+    x_rows[rows, offense] = 1
+    x_rows[rows, defense + n_players] = -1
     # Target values into numpy_matrix
-    y_rows = possessions.as_matrix([name])
+    y_rows = possessions[[name]].values
     # List of possessions
-    poss_vector = possessions[possessions]
+    poss_vector = possessions['possessions']
     return x_rows, y_rows, poss_vector
 
+def sparse_design_matrix(offense, defense, n_players):
+    '''
+    :param offense: nx5 array of offensive player column ids
+    :param defense: nx5 array of defensive player column ids
+    :param n_players: number of players in the registry
+    :return: n x 2*n_players CSR matrix with the same dummy variables as generate_pbp_matrix
+    '''
+    n = offense.shape[0]
+    rows = np.repeat(np.arange(n, dtype=np.int32), 10)
+    cols = np.concatenate([offense, defense + n_players], axis=1).ravel()
+    vals = np.tile(np.array([1.0] * 5 + [-1.0] * 5), n)
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(n, n_players * 2))
+
+def possession_exposure(train_x, weights):
+    '''
+    :param train_x: nx(2 * registry size) training matrix, dense or sparse
+    :param weights: n possession weights
+    :return: vector of 2 * registry size with the possessions played in every column: the offensive possessions of
+    every player followed by their defensive possessions. These are the column sums of the matrix weighted by
+    possessions
+    '''
+    return np.ravel(abs(train_x).T @ np.asarray(weights, dtype=np.float64))
+
+def frame_exposure(possessions, registry):
+    '''
+    :param possessions: parsed possessions data frame, every possession and not only the rows a target is fit on
+    :param registry: player registry
+    :return: possession exposure vector like possession_exposure, counted in possessions whatever the target. Four
+    factor fits are weighted by FGA or rebound chances, so their exposure has to come from the parsed possessions
+    '''
+    offense, defense = possession_player_indices(possessions, registry)
+    weights = possessions['possessions'] if 'possessions' in possessions.columns else np.ones(len(possessions))
+    return possession_exposure(sparse_design_matrix(offense, defense, len(registry['ids'])), weights)
+
+def exposure_table(exposure, registry, threshold=None):
+    '''
+    :param exposure: possession exposure vector from possession_exposure
+    :param registry: player registry the exposure was computed with
+    :param threshold: optional replacement level threshold, total possessions a player needs to get their own columns
+    :return: data frame with the offensive and defensive possessions of every registry player, in registry order, and
+    whether they are pooled into the replacement level columns
+    '''
+    n_players = len(registry['ids'])
+    table = pd.DataFrame({
+        'playerId': registry['ids'],
+        'offensive_possessions': exposure[0:n_players],
+        'defensive_possessions': exposure[n_players:]
+    })
+    total = table['offensive_possessions'] + table['defensive_possessions']
+    table['replacement'] = total < threshold if threshold is not None else False
+    return table
+
+def replacement_column_map(replacement):
+    '''
+    :param replacement: boolean vector over the registry, True for players pooled into the replacement level columns
+    :return: column of every registry player in the reduced matrix, kept players in registry order and then one
+    replacement level column shared by every pooled player
+    '''
+    replacement = np.asarray(replacement, dtype=bool)
+    column_map = np.cumsum(~replacement) - 1
+    column_map[replacement] = np.count_nonzero(~replacement)
+    return column_map
+
+def replacement_pooling_matrix(column_map):
+    '''
+    :param column_map: reduced column of every registry player
+    :return: sparse (2 * registry size) x (2 * reduced size) matrix summing each player's offensive and defensive column
+    into their reduced columns. X @ pool is the reduced training matrix
+    '''
+    n_players = len(column_map)
+    n_reduced = column_map.max() + 1
+    cols = np.concatenate([column_map, column_map + n_reduced])
+    return sparse.csr_matrix((np.ones(n_players * 2), (np.arange(n_players * 2), cols)),
+                             shape=(n_players * 2, n_reduced * 2))
+
+def reduce_design_matrix(train_x, column_map):
+    '''
+    :param train_x: nx(2 * registry size) training matrix, dense or sparse
+    :param column_map: reduced column of every registry player
+    :return: training matrix over the reduced columns. Pooled players on the floor together add up in the replacement
+    level column
+    '''
+    pooled = train_x @ replacement_pooling_matrix(column_map)
+    return pooled.tocsr() if sparse.issparse(pooled) else np.asarray(pooled)
+
+def expand_coefficients(coef, column_map):
+    '''
+    :param coef: coefficients of the reduced fit, offense then defense
+    :param column_map: reduced column of every registry player
+    :return: vector of 2 * registry size coefficients, pooled players all get the replacement level values
+    '''
+    coef = np.ravel(coef)
+    n_reduced = column_map.max() + 1
+    return coef[np.concatenate([column_map, column_map + n_reduced])]
+
 def lambda_to_alpha(lambda_value, samples):
     '''
     turns lambda into alpha value for ridge CV
@@ -104,44 +225,155 @@ def alpha_to_lambda(alpha_value, samples):
 
 
 
-def calculate_rapm(train_x, train_y, possessions, lambdas, name, players):
+def solve_sparse_ridge(train_x, train_y, weights, penalty, tol=1e-8, maxiter=None):
+    '''
+    :param train_x: sparse nxm training matrix
+    :param train_y: n target vector
+    :param weights: n sample weights (possessions)
+    :param penalty: m vector with the ridge alpha of each column, or a sparse mxm penalty matrix
+    :param tol: relative tolerance for conjugate gradient
+    :param maxiter: maximum conjugate gradient iterations
+    :return: coefficients and intercept of the weighted ridge regression with an unpenalized intercept
+    Solves (Xc'WXc + P) b = Xc'W(y - y_mean) by conjugate gradient, where Xc is X centered on its weighted column
+    means. Xc is never built, and the solver only needs products with X and X', so memory stays linear in the number of
+    non zeros even with hundreds of thousands of columns.
+    '''
+    train_x = sparse.csr_matrix(train_x)
+    train_y = np.asarray(train_y, dtype=np.float64).ravel()
+    weights = np.asarray(weights, dtype=np.float64).ravel()
+    x_t = train_x.T.tocsr()
+    weight_sum = weights.sum()
+    x_mean = (x_t @ weights) / weight_sum
+    y_mean = (weights @ train_y) / weight_sum
+
+    if sparse.issparse(penalty):
+        penalty = sparse.csr_matrix(penalty)
+        penalty_diag = penalty.diagonal()
+        apply_penalty = lambda v: penalty @ v
+    else:
+        penalty_diag = np.asarray(penalty, dtype=np.float64)
+        apply_penalty = lambda v: penalty_diag * v
+
+    def matvec(v):
+        v = np.ravel(v)
+        return x_t @ (weights * (train_x @ v)) - weight_sum * x_mean * (x_mean @ v) + apply_penalty(v)
+
+    n_columns = train_x.shape[1]
+    system = LinearOperator((n_columns, n_columns), matvec=matvec, dtype=np.float64)
+    rhs = x_t @ (weights * train_y) - weight_sum * x_mean * y_mean
+
+    # Jacobi preconditioner from the diagonal of the system
+    diagonal = train_x.multiply(train_x).T @ weights - weight_sum * x_mean ** 2 + penalty_diag
+    diagonal[diagonal <= 0] = 1.0
+    preconditioner = LinearOperator((n_columns, n_columns), matvec=lambda v: np.ravel(v) / diagonal,
+                                    dtype=np.float64)
+
+    coef, info = cg(system, rhs, rtol=tol, maxiter=maxiter, M=preconditioner)
+    if info > 0:
+        raise RuntimeError('Conjugate gradient did not converge in {} iterations'.format(info))
+    return coef, y_mean - x_mean @ coef
+
+def calculate_rapm(train_x, train_y, possessions, lambdas, name, registry, replacement_threshold=None,
+                   exposure_weighted=False, played_possessions=None):
     '''
     :param train_x: nxm training matrix
     :param train_y: nxm training matrixk
     :param possessions: nx1 target matrix
     :param lambdas: list of lambdas
     :param name: name we want to give the value
-    :param players: list of players
+    :param registry: player registry the training matrix was built with
+    :param replacement_threshold: optional number of possessions (offense plus defense) a player needs to get their
+    own columns. Players under it are pooled into shared replacement level columns before the fit, e.g.
+    replacement_level_possessions
+    :param exposure_weighted: if True the offensive and defensive values are combined weighted by the possessions
+    played on each side
+    :param played_possessions: optional possession exposure vector from frame_exposure, used for the two options above.
+    Defaults to the column sums of train_x weighted by the sample weights, which is only right when the weights are
+    possessions. For four factor fits pass frame_exposure of the parsed possessions
     :return: RAPM value
     '''
     # convert our lambdas to alphas
     alphas = [lambda_to_alpha(l, train_x.shape[0]) for l in lambdas]
 
+    exposure = None
+    fit_x = train_x
+    if replacement_threshold is not None or exposure_weighted:
+        if played_possessions is None:
+            played_possessions = possession_exposure(train_x, possessions)
+        exposure = exposure_table(played_possessions, registry, replacement_threshold)
+    if replacement_threshold is not None:
+        # Fit the smaller matrix where the low minute players share one pair of columns
+        column_map = replacement_column_map(exposure['replacement'].values)
+        fit_x = reduce_design_matrix(train_x, column_map)
+
     # create a 5 fold CV ridgeCV model. Our target data is not centered at 0, so we want to fit to an intercept.
-    clf = RidgeCV(alphas=alphas, cv=5, fit_intercept=True, normalize=False)
+    clf = RidgeCV(alphas=alphas, cv=5, fit_intercept=True)
 
     # fit our training data
-    model = clf.fit(train_x, train_y, sample_weight=possessions)
+    model = clf.fit(fit_x, train_y, sample_weight=possessions)
+
+    coef = model.coef_
+    if replacement_threshold is not None:
+        coef = expand_coefficients(coef, column_map)
+
+    played = np.abs(train_x).sum(axis=0)
+    return rapm_frame(coef, model.intercept_, name, registry, played,
+                      alpha_to_lambda(model.alpha_, train_x.shape[0]), exposure, exposure_weighted)
+
+def rapm_frame(coef, intercept, name, registry, played, lambda_value=None, exposure=None, exposure_weighted=False):
+    '''
+    :param coef: vector of 2 * registry size coefficients, offense then defense
+    :param intercept: 1 element array with the model intercept
+    :param name: name we want to give the value
+    :param registry: player registry the coefficients were fit with
+    :param played: vector of 2 * registry size, non zero for columns that appear in the training data
+    :param lambda_value: optional lambda chosen by cross validation, kept for reference like the intercept
+    :param exposure: optional exposure table from exposure_table, its possessions and replacement columns are added
+    :param exposure_weighted: if True (needs exposure) the offensive and defensive values are combined weighted by the
+    possessions played on each side
+    :return: data frame of RAPM values and ranks, and the intercept
+    '''
+    players = registry['ids']
+    coef = np.asarray(coef).reshape(1, -1)
+    intercept = np.atleast_1d(intercept)
+    played = np.asarray(played).ravel()
 
     # convert our list of players into a mx1 matrix
     player_arr = np.transpose(np.array(players).reshape(1, len(players)))
 
     # extract our coefficients into the offensive and defensive parts
-    coef_offensive_array = np.transpose(model.coef_[:, 0:len(players)])
-    coef_defensive_array = np.transpose(model.coef_[:, len(players):])
+    coef_offensive_array = np.transpose(coef[:, 0:len(players)])
+    coef_defensive_array = np.transpose(coef[:, len(players):])
 
     # concatenate the offensive and defensive values with the playey ids into a mx3 matrix
     player_id_with_coef = np.concatenate([player_arr, coef_offensive_array, coef_defensive_array], axis=1)
     # build a dataframe from our matrix
     players_coef = pd.DataFrame(player_id_with_coef)
-    intercept = model.intercept_
 
     # apply new column names
     players_coef.columns = ['playerId', '{0}__Off'.format(name), '{0}__Def'.format(name)]
-
-    # Add the offesnive and defensive components together (we should really be weighing this to the number of offensive
-    # and defensive possession played as they are often not equal).
-    players_coef[name] = players_coef['{0}__Off'.format(name)] + players_coef['{0}__Def'.format(name)]
+    players_coef[['{0}__Off'.format(name), '{0}__Def'.format(name)]] = players_coef[
+        ['{0}__Off'.format(name), '{0}__Def'.format(name)]].astype(float)
+
+    if exposure is not None:
+        players_coef['{0}__Off_Poss'.format(name)] = exposure['offensive_possessions'].values
+        players_coef['{0}__Def_Poss'.format(name)] = exposure['defensive_possessions'].values
+        players_coef['{0}__replacement'.format(name)] = exposure['replacement'].values
+
+    # The registry covers every player we have ever seen, only keep the players who played in these possessions
+    players_coef = players_coef[(played[0:len(players)] + played[len(players):]) > 0].reset_index(drop=True)
+
+    if exposure_weighted:
+        # Weigh the offensive and defensive components by the number of offensive and defensive possessions played, as
+        # they are often not equal. Equal exposure gives the same value as adding them together
+        off_poss = players_coef['{0}__Off_Poss'.format(name)]
+        def_poss = players_coef['{0}__Def_Poss'.format(name)]
+        players_coef[name] = (players_coef['{0}__Off'.format(name)] * off_poss +
+                              players_coef['{0}__Def'.format(name)] * def_poss) * 2 / (off_poss + def_poss)
+    else:
+        # Add the offesnive and defensive components together (we should really be weighing this to the number of
+        # offensive and defensive possession played as they are often not equal, see exposure_weighted).
+        players_coef[name] = players_coef['{0}__Off'.format(name)] + players_coef['{0}__Def'.format(name)]
 
     # rank the values
     players_coef['{0}_Rank'.format(name)] = players_coef[name].rank(ascending=False)
@@ -150,36 +382,39 @@ def calculate_rapm(train_x, train_y, possessions, lambdas, name, players):
 
     # add the intercept for reference
     players_coef['{0}__intercept'.format(name)] = intercept[0]
+    if lambda_value is not None:
+        players_coef['{0}__lambda'.format(name)] = lambda_value
 
     return players_coef, intercept
 
-# Here are some prefiltered possessions for RAPM from Ryan Davis, I wasn't able to get the parser working in time for
-# the presentation so I used this data to make the RAPM data I showed in the presentation
-possessions = pd.read_csv('data/rapm_possessions.csv')
-# build_player_list(possessions).to_csv('data/player_names.csv', index=False)
-players = pd.read_csv('data/player_names.csv')
+if __name__ == '__main__':
+    # Here are some prefiltered possessions for RAPM from Ryan Davis, I wasn't able to get the parser working in time for
+    # the presentation so I used this data to make the RAPM data I showed in the presentation
+    possessions = pd.read_csv('data/rapm_possessions.csv')
+    # The player registry (data/player_names.csv) gives every player a fixed column in the matrix
+    registry = load_player_registry()
 
-# The data I downloaded was parsed differently: some possessions are 0 possession possessions where nothing happens
-# I will just filter out the possessions that aren't actually possessions
+    # The data I downloaded was parsed differently: some possessions are 0 possession possessions where nothing happens
+    # I will just filter out the possessions that aren't actually possessions
 
-possessions = possessions[possessions['possessions'] > 0]
+    possessions = possessions[possessions['possessions'] > 0]
 
-possessions = adjust_to_per_poss(possessions, 'points')
+    possessions = adjust_to_per_poss(possessions, 'points')
 
-# extract the training data from our possession data frame
-train_x, train_y, possessions_raw = generate_pbp_matrix(possessions, 'points per possession', players)
+    # extract the training data from our possession data frame
+    train_x, train_y, possessions_raw = generate_pbp_matrix(possessions, 'points per possession', registry)
 
-# calculate the RAPM
-results, intercept = calculate_rapm(train_x, train_y, possessions_raw, lambdas_rapm, 'RAPM', players)
+    # calculate the RAPM
+    results, intercept = calculate_rapm(train_x, train_y, possessions_raw, lambdas_rapm, 'RAPM', registry)
 
-# round to 2 decimal places for display
-results = np.round(results, decimals=2)
+    # round to 2 decimal places for display
+    results = np.round(results, decimals=2)
 
-# sort the columns
-results = results.reindex(sorted(results.columns), axis=1)
+    # sort the columns
+    results = results.reindex(sorted(results.columns), axis=1)
 
-# join back with player names
-results = players.merge(results, how='inner', on='playerId')
+    # join back with player names
+    results = registry_frame(registry)[['playerId', 'playerName']].merge(results, how='inner', on='playerId')
 
-# save as CSV
-# results.to_csv('data/rapm.csv')
+    # save as CSV
+    # results.to_csv('data/rapm.csv')
@@ -0,0 +1,178 @@
+# Import os for relative pathing to data
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import numpy as np
+import pandas as pd
+from player_registry import player_key, player_indices
+from rapm import generate_pbp_matrix, calculate_rapm, rapm_frame, lambdas_rapm, offense_columns, defense_columns
+
+# Cache of fitted RAPM results.
+# A fit is keyed by a hash of the possessions that go into it (players, target and possession columns only) plus the
+# fit parameters. The coefficients, intercept and chosen lambda are kept in a local SQLite file, least recently used
+# fits are evicted once the cache is full, and the coefficient table is indexed by player so we can look a player up
+# across every cached window.
+cache_path = os.path.join(os.path.dirname(__file__), 'data', 'rapm_cache.sqlite')
+max_cached_fits = 200
+
+
+def open_cache(path=cache_path):
+    '''
+    :param path: path to the SQLite file
+    :return: connection to the cache, with the tables created if needed
+    '''
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS fits (
+            fit_key TEXT PRIMARY KEY,
+            dataset_hash TEXT,
+            name TEXT,
+            target TEXT,
+            window TEXT,
+            lambdas TEXT,
+            chosen_lambda REAL,
+            intercept REAL,
+            possessions INTEGER,
+            created REAL,
+            last_used REAL
+        );
+        CREATE INDEX IF NOT EXISTS fits_last_used ON fits (last_used);
+        CREATE TABLE IF NOT EXISTS coefficients (
+            fit_key TEXT,
+            player_id TEXT,
+            offense REAL,
+            defense REAL
+        );
+        CREATE INDEX IF NOT EXISTS coefficients_fit ON coefficients (fit_key);
+        CREATE INDEX IF NOT EXISTS coefficients_player ON coefficients (player_id);
+    ''')
+    return conn
+
+
+def dataset_hash(possessions, target):
+    '''
+    :param possessions: possessions data frame
+    :param target: target column
+    :return: hex digest of the columns that go into a fit, so changes to any other column do not invalidate the cache
+    '''
+    columns = offense_columns + defense_columns + [target, 'possessions']
+    digest = hashlib.sha1(json.dumps(columns).encode())
+    digest.update(pd.util.hash_pandas_object(possessions[columns].astype(str), index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def fit_key(data_hash, name, target, window, lambdas):
+    '''
+    :return: hex digest identifying a fit of the dataset with these parameters
+    '''
+    return hashlib.sha1(json.dumps([data_hash, name, target, window, list(lambdas)]).encode()).hexdigest()
+
+
+def load_fit(conn, key, registry):
+    '''
+    :param conn: cache connection
+    :param key: fit key
+    :param registry: player registry
+    :return: the same data frame and intercept calculate_rapm returns, or None if the fit is not cached
+    '''
+    fit = conn.execute('SELECT name, chosen_lambda, intercept FROM fits WHERE fit_key = ?', (key,)).fetchone()
+    if fit is None:
+        return None
+    name, chosen_lambda, intercept = fit
+    conn.execute('UPDATE fits SET last_used = ? WHERE fit_key = ?', (time.time(), key))
+    conn.commit()
+
+    coefficients = pd.read_sql_query('SELECT player_id, offense, defense FROM coefficients WHERE fit_key = ?', conn,
+                                     params=(key,))
+    # Rebuild the coefficient vector over the registry and let rapm_frame redo the ranks
+    n_players = len(registry['ids'])
+    columns = player_indices(registry, coefficients['player_id'].values)
+    coef = np.zeros(n_players * 2)
+    played = np.zeros(n_players * 2)
+    coef[columns] = coefficients['offense'].values
+    coef[columns + n_players] = coefficients['defense'].values
+    played[columns] = 1
+    return rapm_frame(coef, np.array([intercept]), name, registry, played, chosen_lambda)
+
+
+def store_fit(conn, key, data_hash, name, target, window, lambdas, n_possessions, players_coef, intercept,
+              max_entries=max_cached_fits):
+    '''
+    :param conn: cache connection
+    :param key: fit key
+    :param players_coef: data frame returned by calculate_rapm
+    :param intercept: intercept returned by calculate_rapm
+    :param max_entries: number of fits to keep, the least recently used ones are evicted
+    :return: Saves the fit in the cache
+    '''
+    now = time.time()
+    chosen_lambda = players_coef['{0}__lambda'.format(name)].iloc[0] if len(players_coef) > 0 else None
+    conn.execute('DELETE FROM coefficients WHERE fit_key = ?', (key,))
+    conn.execute('INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 (key, data_hash, name, target, window, json.dumps(list(lambdas)), chosen_lambda,
+                  float(intercept[0]), int(n_possessions), now, now))
+    conn.executemany('INSERT INTO coefficients VALUES (?, ?, ?, ?)',
+                     zip([key] * len(players_coef), players_coef['playerId'].astype(str),
+                         players_coef['{0}__Off'.format(name)].astype(float),
+                         players_coef['{0}__Def'.format(name)].astype(float)))
+
+    # Evict the least recently used fits
+    evicted = conn.execute('SELECT fit_key FROM fits ORDER BY last_used DESC LIMIT -1 OFFSET ?',
+                           (max_entries,)).fetchall()
+    conn.executemany('DELETE FROM coefficients WHERE fit_key = ?', evicted)
+    conn.executemany('DELETE FROM fits WHERE fit_key = ?', evicted)
+    conn.commit()
+
+
+def cached_rapm(possessions, target, name, registry, lambdas=lambdas_rapm, window='', path=cache_path,
+                max_entries=max_cached_fits):
+    '''
+    :param possessions: possessions data frame, already filtered and with the target column
+    :param target: target column, e.g. 'points per possession'
+    :param name: name we want to give the value
+    :param registry: player registry
+    :param lambdas: list of lambdas
+    :param window: label for the possessions, e.g. the seasons '2018-21', used by player_history
+    :param path: path to the SQLite file
+    :param max_entries: number of fits to keep
+    :return: RAPM data frame and intercept like calculate_rapm, only fit if this configuration is not cached
+    '''
+    data_hash = dataset_hash(possessions, target)
+    key = fit_key(data_hash, name, target, window, lambdas)
+    conn = open_cache(path)
+    try:
+        cached = load_fit(conn, key, registry)
+        if cached is not None:
+            return cached
+        train_x, train_y, possessions_raw = generate_pbp_matrix(possessions, target, registry)
+        players_coef, intercept = calculate_rapm(train_x, train_y, possessions_raw, lambdas, name, registry)
+        store_fit(conn, key, data_hash, name, target, window, lambdas, len(possessions), players_coef, intercept,
+                  max_entries)
+        return players_coef, intercept
+    finally:
+        conn.close()
+
+
+def player_history(player_id, name=None, path=cache_path):
+    '''
+    :param player_id: player id
+    :param name: only fits with this name, e.g. 'RAPM'
+    :param path: path to the SQLite file
+    :return: data frame with the player's coefficients in every cached fit
+    '''
+    conn = open_cache(path)
+    try:
+        query = '''
+            SELECT f.window, f.name, f.target, f.chosen_lambda, f.intercept, f.possessions, f.created,
+                   c.offense, c.defense, c.offense + c.defense AS total
+            FROM coefficients c JOIN fits f ON c.fit_key = f.fit_key
+            WHERE c.player_id = ?'''
+        params = [player_key(player_id)]
+        if name is not None:
+            query += ' AND f.name = ?'
+            params.append(name)
+        return pd.read_sql_query(query + ' ORDER BY f.window, f.created', conn, params=params)
+    finally:
+        conn.close()
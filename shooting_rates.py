@@ -0,0 +1,118 @@
+# Import os for relative pathing to data
+import os
+import numpy as np
+import pandas as pd
+from pbp_utils import event_type, home_description, away_description, player1_id
+
+# Shooting rate tables for luck adjusted RAPM (LA_RAPM).
+# Three point shooting and free throw shooting are the noisiest parts of a possession's points, so the luck adjusted
+# target values every three point attempt at the league average 3P% and every free throw at the shooter's season FT%,
+# instead of whether it went in. The rates are counted once per season from the play by play and saved, then the parser
+# looks them up to add an expected points value to every event.
+expected_points_column = 'EXPECTED_POINTS'
+
+# Free throw attempts of league average shooting added to each player's FT% so low volume shooters are pulled to the mean
+ft_prior_attempts = 50
+
+
+def shooting_counts(play_by_play):
+    '''
+    :param play_by_play: play by play data frame, any number of games
+    :return: data frame of three point attempts/makes and free throw attempts/makes per player
+    '''
+    descriptions = play_by_play[home_description].fillna('') + play_by_play[away_description].fillna('')
+    shots = play_by_play[event_type].isin([1, 2])
+    three = shots & descriptions.str.contains('3PT')
+    free_throw = play_by_play[event_type] == 3
+    counts = pd.DataFrame({
+        'playerId': play_by_play[player1_id],
+        'FG3A': three.astype(int),
+        'FG3M': (three & (play_by_play[event_type] == 1)).astype(int),
+        'FTA': free_throw.astype(int),
+        'FTM': (free_throw & ~descriptions.str.contains('MISS')).astype(int)
+    })
+    counts = counts[three | free_throw]
+    return counts.groupby('playerId', as_index=False).sum()
+
+
+def build_shooting_rates(play_by_play_frames):
+    '''
+    :param play_by_play_frames: list of play by play data frames, e.g. every game of a season
+    :return: shooting rates: league 3P%, league FT% and a player id -> FT% map
+    '''
+    counts = pd.concat([shooting_counts(frame) for frame in play_by_play_frames])
+    return rates_from_counts(counts.groupby('playerId', as_index=False).sum())
+
+
+def rates_from_counts(counts):
+    '''
+    :param counts: data frame of playerId, FG3A, FG3M, FTA, FTM
+    :return: shooting rates
+    '''
+    three_pct = counts['FG3M'].sum() / max(counts['FG3A'].sum(), 1)
+    league_ft_pct = counts['FTM'].sum() / max(counts['FTA'].sum(), 1)
+    ft_pct = (counts['FTM'] + ft_prior_attempts * league_ft_pct) / (counts['FTA'] + ft_prior_attempts)
+    return {
+        'three_pct': three_pct,
+        'ft_pct': league_ft_pct,
+        'player_ft_pct': dict(zip(counts['playerId'].astype(float).astype(int), ft_pct)),
+        'counts': counts
+    }
+
+
+def save_shooting_rates(rates, season):
+    '''
+    :param rates: shooting rates
+    :param season: season label, e.g. '2020-21'
+    :return: Saves the per player counts the rates are computed from as a CSV
+    '''
+    rates['counts'].to_csv(shooting_rates_path(season), index=False)
+
+
+def load_shooting_rates(season):
+    '''
+    :param season: season label, e.g. '2020-21'
+    :return: shooting rates saved by save_shooting_rates
+    '''
+    return rates_from_counts(pd.read_csv(shooting_rates_path(season)))
+
+
+def shooting_rates_path(season):
+    return os.path.join(os.path.dirname(__file__), 'data', 'shooting_rates_{}.csv'.format(season))
+
+
+def add_expected_points(play_by_play, rates):
+    '''
+    :param play_by_play: play by play data frame with the descriptions filled in
+    :param rates: shooting rates
+    :return: play by play with the expected points column: 3 * league 3P% for three point attempts, 2 for made twos,
+    the shooter's FT% for free throws and 0 for everything else
+    '''
+    descriptions = play_by_play[home_description] + play_by_play[away_description]
+    shots = play_by_play[event_type].isin([1, 2])
+    three = shots & descriptions.str.contains('3PT')
+    made_two = (play_by_play[event_type] == 1) & ~three
+    free_throw = play_by_play[event_type] == 3
+    ft_pct = pd.to_numeric(play_by_play[player1_id], errors='coerce').map(rates['player_ft_pct']) \
+        .fillna(rates['ft_pct'])
+    play_by_play[expected_points_column] = np.where(three, 3 * rates['three_pct'],
+                                                    np.where(made_two, 2.0, np.where(free_throw, ft_pct, 0.0)))
+    return play_by_play
+
+
+def event_expected_points(row, rates):
+    '''
+    :param row: a single play by play event with the descriptions filled in
+    :param rates: shooting rates
+    :return: expected points of the event, the same values add_expected_points gives
+    '''
+    if row[event_type] in [1, 2] and '3PT' in row[home_description] + row[away_description]:
+        return 3 * rates['three_pct']
+    elif row[event_type] == 1:
+        return 2.0
+    elif row[event_type] == 3:
+        try:
+            return rates['player_ft_pct'].get(int(row[player1_id]), rates['ft_pct'])
+        except (TypeError, ValueError):
+            return rates['ft_pct']
+    return 0.0